@@ -0,0 +1,4 @@
+import sys
+import ultraimport
+
+sys.exit(ultraimport.main())
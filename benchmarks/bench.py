@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+#
+# Benchmarks for ultraimport
+#
+# Generates synthetic source trees and measures import throughput, latency and memory in fresh subprocesses.
+#
+# Usage:
+#   python benchmarks/bench.py run [--quick] [--revision REV] [--output results.json]
+#   python benchmarks/bench.py compare base.json head.json [--threshold 0.1]
+#
+# Compare two revisions:
+#   python benchmarks/bench.py run --revision main --output main.json
+#   python benchmarks/bench.py run --output head.json
+#   python benchmarks/bench.py compare main.json head.json
+#
+# A failing scenario makes `run` exit with status 1, except with --revision, because older revisions might not support
+# all scenarios. Their failures are recorded in the results. `compare` exits with status 1 if a scenario failed in head.
+#
+
+import argparse, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = {
+    'default': { 'startup': None, 'flat': 2000, 'nested': 50, 'recurse': 300, 'large': 20000, 'lazy': 200, 'repeat': 5, 'loops': 100000 },
+    'quick': { 'startup': None, 'flat': 200, 'nested': 10, 'recurse': 30, 'large': 2000, 'lazy': 50, 'repeat': 2, 'loops': 10000 },
+}
+
+# Reported by every child process, peak resident set size in KiB
+CHILD_FOOTER = """
+import json, sys
+try:
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    maxrss_kib = maxrss // 1024 if sys.platform == 'darwin' else maxrss
+except ImportError:
+    maxrss_kib = None
+print(json.dumps({ **results, 'maxrss_kib': maxrss_kib }))
+"""
+
+##############
+# GENERATORS #
+##############
+
+def write(file_path, content):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as f:
+        f.write(content)
+
+def main_script(body):
+    """ Wrap `body` into a child script that measures the time until `results` are printed """
+    return ("import time\nstarted = time.perf_counter()\nimport ultraimport\nresults = {}\n"
+            f"{body}\n"
+            "results.setdefault('import_s', time.perf_counter() - started)\n"
+            f"{CHILD_FOOTER}")
+
+def generate_startup(path, size):
+    """ Only `import ultraimport`, the cost every short-lived process pays """
+    write(f'{path}/main.py', main_script(
+        "import sys\nresults['import_s'] = time.perf_counter() - started\nresults['modules'] = len(sys.modules)"))
+
+def generate_flat(path, size):
+    """ Thousands of independent files in one directory """
+    for i in range(size):
+        write(f'{path}/m{i}.py', f'value = {i}\n')
+    write(f'{path}/main.py', main_script(
+        f"for i in range({size}):\n    ultraimport(f'__dir__/m{{i}}.py', caller=__file__)"))
+
+def generate_nested(path, size):
+    """ A chain of deeply nested packages, each module imports the one in the subdirectory """
+    dir_name = path
+    for level in range(size):
+        dir_name = f'{dir_name}/p{level}'
+        child = f"ultraimport('__dir__/p{level + 1}/mod.py', package=2)\n" if level < size - 1 else ''
+        write(f'{dir_name}/mod.py', f'import ultraimport\n{child}value = {level}\n')
+    write(f'{path}/main.py', main_script("ultraimport('__dir__/p0/mod.py', package=1)"))
+
+def generate_recurse(path, size):
+    """ A package whose modules use relative imports of each other, imported with `recurse=True` """
+    write(f'{path}/pkg/__init__.py', '')
+    for i in range(size):
+        imports = ''.join(f'from .m{j} import value as v{j}\n' for j in sorted({ i // 2, i // 3, i // 5 }) if 0 <= j < i)
+        write(f'{path}/pkg/m{i}.py', f'{imports}value = {i}\n')
+    write(f'{path}/main.py', main_script(f"ultraimport('__dir__/pkg/m{size - 1}.py', recurse=True)"))
+
+def generate_large(path, size):
+    """ One large generated module """
+    functions = ''.join(f'def f{i}(x):\n    return x + {i}\n\n' for i in range(size))
+    write(f'{path}/large.py', functions)
+    write(f'{path}/main.py', main_script("ultraimport('__dir__/large.py')"))
+
+def generate_lazy(path, size):
+    """ Two modules that import each other lazily and call each other alternately """
+    for name, other in (('a', 'b'), ('b', 'a')):
+        write(f'{path}/{name}.py',
+              "import ultraimport\n"
+              f"{other}_func = ultraimport('__dir__/{other}.py', {{'{other}_func': callable}}, lazy=True)\n"
+              f"def {name}_func(n):\n    return {other}_func(n - 1) + 1 if n else 0\n")
+    write(f'{path}/main.py', main_script(f"assert ultraimport('__dir__/a.py', 'a_func')({size}) == {size}"))
+
+def generate_micro(path, size):
+    """ Latency of cache hits, bind(), lazy calls and preprocessing """
+    write(f'{path}/target.py', 'def func(x):\n    return x\n')
+    write(f'{path}/large.py', ''.join(f'def f{i}(x):\n    return x + {i}\n\n' for i in range(size['large'] // 10)))
+    write(f'{path}/main.py', main_script(f"""
+loops = {size['loops']}
+
+def per_call_us(func, loops=loops):
+    started = time.perf_counter()
+    for _ in range(loops):
+        func()
+    return (time.perf_counter() - started) / loops * 1e6
+
+def best_s(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+ultraimport('__dir__/target.py', caller=__file__)
+results['cache_hit_us'] = per_call_us(lambda: ultraimport('__dir__/target.py', caller=__file__))
+results['cache_hit_object_us'] = per_call_us(lambda: ultraimport('__dir__/target.py', 'func', caller=__file__))
+
+if hasattr(ultraimport, 'bind'):
+    func = ultraimport.bind('__dir__/target.py', 'func', caller=__file__)
+    results['bind_us'] = per_call_us(func)
+
+direct = ultraimport('__dir__/target.py', 'func', caller=__file__)
+lazy = ultraimport('__dir__/target.py', {{'func': callable}}, lazy=True)
+results['direct_call_us'] = per_call_us(lambda: direct(1))
+results['lazy_call_us'] = per_call_us(lambda: lazy(1))
+results['lazy_call_overhead_us'] = results['lazy_call_us'] - results['direct_call_us']
+
+# Lazy objects added to a namespace replace themselves on first use
+namespace = {{ '__name__': 'bench' }}
+ultraimport('__dir__/target.py', {{'func': callable}}, add_to_ns=namespace, lazy=True)
+namespace['func'](1)
+results['lazy_replaced_call_us'] = per_call_us(lambda: namespace['func'](1))
+
+plain = best_s(lambda: ultraimport('__dir__/large.py', use_cache=False))
+preprocessed = best_s(lambda: ultraimport('__dir__/large.py', use_cache=False, preprocessor=lambda source, *args, **kwargs: source,
+                                          use_preprocessor_cache=False))
+results['preprocessor_overhead_ms'] = (preprocessed - plain) * 1e3
+"""))
+
+SCENARIOS = {
+    'startup': generate_startup,
+    'flat': generate_flat,
+    'nested': generate_nested,
+    'recurse': generate_recurse,
+    'large': generate_large,
+    'lazy': generate_lazy,
+}
+
+###########
+# RUNNING #
+###########
+
+def clear_caches(path):
+    """ Remove bytecode and preprocessor caches, so the next import is cold """
+    for dir_name, dir_names, file_names in os.walk(path):
+        if '__pycache__' in dir_names:
+            shutil.rmtree(os.path.join(dir_name, '__pycache__'))
+            dir_names.remove('__pycache__')
+        for file_name in file_names:
+            if '__preprocessed__' in file_name:
+                os.remove(os.path.join(dir_name, file_name))
+
+def run_child(script, ultraimport_path):
+    env = os.environ.copy()
+    env['PYTHONPATH'] = ultraimport_path
+    # Benchmarks must not be influenced by stats or tracing, warm runs need bytecode caches
+    for name in ('ULTRAIMPORT_STATS', 'ULTRAIMPORT_TRACE', 'PYTHONDONTWRITEBYTECODE'):
+        env.pop(name, None)
+
+    started = time.perf_counter()
+    ret = subprocess.run([sys.executable, script], env=env, capture_output=True, text=True)
+    wall_s = time.perf_counter() - started
+    if ret.returncode != 0:
+        raise RuntimeError(f'{script} failed:\n{ret.stderr}')
+    result = json.loads(ret.stdout.strip().splitlines()[-1])
+    result['wall_s'] = wall_s
+    return result
+
+def run_scenario(path, ultraimport_path, repeat):
+    """ Run a generated tree once cold and `repeat` times warm, each in a fresh process """
+    script = os.path.join(path, 'main.py')
+    clear_caches(path)
+    cold = run_child(script, ultraimport_path)
+    warm = [ run_child(script, ultraimport_path) for _ in range(repeat) ]
+    result = {
+        'cold_s': cold['import_s'],
+        'cold_wall_s': cold['wall_s'],
+        'warm_s': statistics.median(result['import_s'] for result in warm),
+        'warm_wall_s': statistics.median(result['wall_s'] for result in warm),
+        'maxrss_kib': max((result['maxrss_kib'] for result in [ cold ] + warm if result['maxrss_kib']), default=None),
+    }
+    # Number of loaded modules, if the scenario reports it
+    if 'modules' in cold:
+        result['modules'] = cold['modules']
+    return result
+
+def checkout_revision(revision, target_dir):
+    """ Write ultraimport.py of a git revision to `target_dir` """
+    source = subprocess.run(['git', 'show', f'{revision}:ultraimport.py'], cwd=ROOT, capture_output=True, check=True).stdout
+    with open(os.path.join(target_dir, 'ultraimport.py'), 'wb') as f:
+        f.write(source)
+
+def git_revision():
+    ret = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    return ret.stdout.strip() if ret.returncode == 0 else None
+
+def run(args):
+    size = SIZES['quick' if args.quick else 'default']
+    scenarios = args.scenarios or list(SCENARIOS) + [ 'micro' ]
+    results = {}
+    # Scenario name -> error message
+    failures = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ultraimport_path = ROOT
+        if args.revision:
+            ultraimport_path = os.path.join(tmp_dir, 'revision')
+            os.makedirs(ultraimport_path)
+            checkout_revision(args.revision, ultraimport_path)
+
+        for name in scenarios:
+            path = os.path.join(tmp_dir, name)
+            print(f'Running {name}...', file=sys.stderr)
+            try:
+                if name == 'micro':
+                    generate_micro(path, size)
+                    result = run_child(os.path.join(path, 'main.py'), ultraimport_path)
+                    del result['import_s']
+                else:
+                    SCENARIOS[name](path, size[name])
+                    result = run_scenario(path, ultraimport_path, size['repeat'])
+            except Exception as e:
+                print(f'Scenario {name} failed: {e}', file=sys.stderr)
+                failures[name] = str(e)
+                continue
+            for key, value in result.items():
+                results[f'{name}.{key}'] = value
+
+    report = {
+        'meta': {
+            'revision': args.revision or git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'size': 'quick' if args.quick else 'default',
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+        'failures': failures,
+    }
+
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    print(data)
+
+    # Older revisions might not support all scenarios, but the working tree must run all of them
+    if failures and not args.revision:
+        sys.exit(1)
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    print(f"{'benchmark':<40} {'base':>12} {'head':>12} {'change':>8}")
+    regressions = []
+    for name in sorted(set(base['results']) | set(head['results'])):
+        base_value, head_value = base['results'].get(name), head['results'].get(name)
+        if base_value is None or head_value is None:
+            print(f"{name:<40} {str(base_value):>12} {str(head_value):>12} {'':>8}")
+            continue
+
+        # All results are lower-is-better times or memory sizes
+        change = (head_value - base_value) / abs(base_value) if base_value else 0.0
+        flag = ''
+        if change > args.threshold:
+            regressions.append(name)
+            flag = ' <- regression'
+        print(f'{name:<40} {base_value:>12.6g} {head_value:>12.6g} {change:>+8.1%}{flag}')
+
+    for name, message in sorted(base.get('failures', {}).items()):
+        print(f'Scenario {name} failed in base, e.g. because it is not supported: {message}')
+
+    # A scenario that crashes in head must not look like missing data
+    failed = dict(head.get('failures', {}))
+    head_scenarios = { name.partition('.')[0] for name in head['results'] }
+    for name in { name.partition('.')[0] for name in base['results'] } - head_scenarios:
+        failed.setdefault(name, 'No results')
+    for name, message in sorted(failed.items()):
+        print(f'Scenario {name} failed in head: {message}')
+
+    if failed or regressions and args.fail_on_regression:
+        sys.exit(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for ultraimport')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks and print the results as JSON')
+    run_parser.add_argument('--quick', action='store_true', help='Use small trees, e.g. for CI')
+    run_parser.add_argument('--revision', help='Benchmark ultraimport.py of a git revision instead of the working tree, '
+                            'scenarios it does not support are recorded as failures')
+    run_parser.add_argument('--output', help='Also write the results to this file')
+    run_parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run, default is all of: {', '.join(list(SCENARIOS) + [ 'micro' ])}")
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change reported as regression')
+    compare_parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 on regressions')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        for name in args.scenarios:
+            if name not in SCENARIOS and name != 'micro':
+                parser.error(f'Unknown scenario: {name}')
+    run(args) if args.command == 'run' else compare(args)
+
+if __name__ == '__main__':
+    main()
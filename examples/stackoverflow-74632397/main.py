@@ -1,10 +1,13 @@
 # main.py
+import sys
 import ultraimport
 
 #This adds `file2` to the `autogenerated` package as a side effect.
-Stuff = ultraimport('__dir__/autogenerated/file2.py', 'OtherStuff', package='autogenerated')
+file2 = ultraimport('__dir__/autogenerated/file2.py', package='autogenerated')
 
-#In `file1`, we try to import `file2`. Luckly we had added it to the autogenerated package above.
+#In `file1`, we try to import `file2` by its plain name. ultraimport gives every module a name that is unique for its
+#path, so we have to make it available under the name `file2` ourselves.
+sys.modules['file2'] = file2
 from autogenerated.file1 import Stuff
 
 print(Stuff)
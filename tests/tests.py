@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 
-import unittest, subprocess, sys, os, tempfile, pathlib
+import unittest, subprocess, sys, os, tempfile, pathlib, json
 
 # So we can find ultraimport without installing it
 sys.path.insert(0, f"{os.path.dirname(__file__)}{os.sep}..{os.sep}..{os.sep}")
 
 import ultraimport
 
+def pid_preprocessor(source, file_path=None):
+    return f'pid = {os.getpid()}'
+
+def failing_preprocessor(source, file_path=None):
+    raise RuntimeError(f'preprocessor failed in {os.getpid()}')
+
 class ultraimportTests(unittest.TestCase):
 
     def setUp(self):
@@ -71,6 +77,960 @@ class ultraimportTests(unittest.TestCase):
             self.assertTrue(pp_cache.is_file(),
                 f"Cached preprocessed file '{pp_cache}' should exist when using `use_preprocessor_cache=True`")
 
+    def test_concurrent_import(self):
+        import threading
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}slow.py'
+            with open(code_file, 'w') as f:
+                print('import time', file=f)
+                print('time.sleep(0.2)', file=f)
+                print('executions.append(1)', file=f)
+
+            executions = []
+            results = []
+            errors = []
+
+            def worker():
+                try:
+                    results.append(ultraimport(code_file, inject={'executions': executions}))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [ threading.Thread(target=worker) for _ in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [], 'Concurrent imports of the same file must not fail')
+            self.assertEqual(len(executions), 1, 'The module must only be executed once')
+            self.assertEqual(len(set(map(id, results))), 1, 'All threads must get the same module')
+
+    def test_import_many(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_paths = []
+            for i in range(8):
+                file_paths.append(f'{tmp_dir}{os.sep}many{i}.py')
+                with open(file_paths[-1], 'w') as f:
+                    print(f'value = {i}', file=f)
+                    print(f'order.append({i})', file=f)
+
+            order = []
+            imports = file_paths[:4] + [ (file_path, 'value') for file_path in file_paths[4:] ]
+            results = ultraimport.import_many(imports, use_cache=False, inject={'order': order})
+
+            self.assertEqual(order, list(range(8)), 'Modules must be executed in the given order')
+            self.assertEqual([ module.value for module in results[:4] ], [0, 1, 2, 3])
+            self.assertEqual(results[4:], [4, 5, 6, 7])
+            self.assertEqual(ultraimport.prefetched, {}, 'No prefetched loaders must be left over')
+
+            with self.assertRaises(ultraimport.ResolveImportError):
+                ultraimport.import_many([file_paths[0], f'{tmp_dir}{os.sep}missing.py'], use_cache=False, inject={'order': order})
+
+    def test_preprocessor_pool(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            with open(code_file, 'w') as f:
+                print('x = 1', file=f)
+
+            ultraimport.start_preprocessor_pool(max_workers=1)
+            try:
+                module = ultraimport(code_file, preprocessor=pid_preprocessor, use_cache=False, use_preprocessor_cache=False)
+                self.assertNotEqual(module.pid, os.getpid(), 'Picklable preprocessors must run in a worker process')
+
+                module = ultraimport(code_file, recurse=True, use_cache=False, use_preprocessor_cache=False)
+                self.assertEqual(module.x, 1)
+
+                # Errors of the preprocessor are raised from the worker, the preprocessor does not run again inline
+                with self.assertRaises(RuntimeError) as cm:
+                    ultraimport(code_file, preprocessor=failing_preprocessor, use_cache=False, use_preprocessor_cache=False)
+                self.assertNotEqual(str(cm.exception), f'preprocessor failed in {os.getpid()}')
+
+                # Lambdas cannot be pickled, so they run inline
+                module = ultraimport(code_file, preprocessor=lambda source, file_path: f'pid = {os.getpid()}',
+                                     use_cache=False, use_preprocessor_cache=False)
+                self.assertEqual(module.pid, os.getpid())
+            finally:
+                ultraimport.stop_preprocessor_pool()
+
+    def test_preprocessor_cache_key(self):
+        calls = []
+        def preprocessor(source, file_path=None):
+            calls.append(file_path)
+            return source.replace(b'VERSION', str(preprocessor.version).encode())
+        preprocessor.version = 1
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            with open(code_file, 'w') as f:
+                print('x = 1, VERSION', file=f)
+            mtime = os.stat(code_file).st_mtime
+
+            module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False)
+            self.assertEqual(module.x, (1, 1))
+            module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False)
+            self.assertEqual(len(calls), 1, 'Unchanged source code must not be preprocessed again')
+
+            # Changed source code with an old modification time, e.g. from a container image layer
+            with open(code_file, 'w') as f:
+                print('x = 2, VERSION', file=f)
+            os.utime(code_file, (mtime - 10, mtime - 10))
+            module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False)
+            self.assertEqual(module.x, (2, 1))
+            self.assertEqual(len(calls), 2, 'Changed source code must be preprocessed again')
+
+            # New version of the preprocessor
+            preprocessor.version = 2
+            module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False)
+            self.assertEqual(module.x, (2, 2))
+            self.assertEqual(len(calls), 3, 'A new preprocessor version must preprocess again')
+
+    def test_code_cache(self):
+        calls = []
+        def preprocessor(source, file_path=None):
+            calls.append(file_path)
+            return source + b'y = 2\n'
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            with open(code_file, 'w') as f:
+                print('x = 1', file=f)
+
+            module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False, use_code_cache=True)
+            self.assertEqual((module.x, module.y), (1, 2))
+            self.assertTrue(os.path.isfile(f'{tmp_dir}{os.sep}code__preprocessed__.py.marshal'))
+            self.assertFalse(os.path.isfile(f'{tmp_dir}{os.sep}code__preprocessed__.py'),
+                'No preprocessed source file must be written when using `use_code_cache=True`')
+
+            module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False, use_code_cache=True)
+            self.assertEqual((module.x, module.y), (1, 2))
+            self.assertEqual(len(calls), 1, 'The cached code object must be used')
+
+    def test_cache_backends(self):
+        calls = []
+        def preprocessor(source, file_path=None):
+            calls.append(file_path)
+            return source + b'y = 2\n'
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            with open(code_file, 'w') as f:
+                print('x = 1', file=f)
+
+            backends = [
+                ultraimport.MemoryCache(),
+                ultraimport.DirectoryCache(f'{tmp_dir}{os.sep}cache'),
+                ultraimport.SQLiteCache(f'{tmp_dir}{os.sep}cache.sqlite'),
+            ]
+            for backend in backends:
+                for use_code_cache in (False, True):
+                    calls.clear()
+                    for _ in range(2):
+                        module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False,
+                                             use_code_cache=use_code_cache, cache_backend=backend)
+                        self.assertEqual((module.x, module.y), (1, 2))
+                    self.assertEqual(len(calls), 1, f'{type(backend).__name__} must cache the preprocessed code')
+
+                backend.clear()
+                ultraimport(code_file, preprocessor=preprocessor, use_cache=False, cache_backend=backend)
+                self.assertEqual(len(calls), 2, f'{type(backend).__name__} must be empty after clear()')
+
+            backends[2].close()
+
+            # clear() must only remove cache entries, other files in the directory are left alone
+            shared_dir = f'{tmp_dir}{os.sep}shared'
+            os.makedirs(f'{shared_dir}{os.sep}subdir')
+            with open(f'{shared_dir}{os.sep}other.txt', 'w') as f:
+                print('keep me', file=f)
+            backend = ultraimport.DirectoryCache(shared_dir)
+            backend.set('entry', 'key', b'data')
+            backend.clear()
+            self.assertIsNone(backend.get('entry', 'key'))
+            self.assertEqual(sorted(os.listdir(shared_dir)), ['other.txt', 'subdir'])
+
+            self.assertFalse(os.path.exists(f'{tmp_dir}{os.sep}code__preprocessed__.py'),
+                'No preprocessed file must be written next to the source code when using a cache backend')
+
+    def test_sqlite_cache_read_only(self):
+        import sqlite3
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.sqlite')
+            backend = ultraimport.SQLiteCache(path)
+            backend.set('entry', 'key', b'data')
+            backend.close()
+            # WAL mode is stored in the database and would prevent reading it from a read-only directory
+            connection = sqlite3.connect(path)
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            connection.close()
+
+            # E.g. a cache that is shipped in a read-only container image
+            with open(path, 'rb') as f:
+                data = f.read()
+            backend = ultraimport.SQLiteCache(path, read_only=True)
+            self.assertEqual(backend.get('entry', 'key'), b'data')
+            backend.set('other', 'key', b'data')
+            backend.clear()
+            self.assertEqual(backend.get('entry', 'key'), b'data')
+            backend.close()
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data, 'A read-only cache must not be changed')
+            self.assertEqual(os.listdir(tmp_dir), [ 'cache.sqlite' ])
+
+            # Without a database, the cache is turned off
+            backend = ultraimport.SQLiteCache(os.path.join(tmp_dir, 'missing.sqlite'), read_only=True)
+            backend.set('entry', 'key', b'data')
+            self.assertIsNone(backend.get('entry', 'key'))
+            backend.close()
+            self.assertEqual(os.listdir(tmp_dir), [ 'cache.sqlite' ])
+
+            # Root can write anyway
+            if not hasattr(os, 'geteuid') or os.geteuid() == 0:
+                return
+            os.chmod(tmp_dir, 0o555)
+            os.chmod(path, 0o444)
+            try:
+                backend = ultraimport.SQLiteCache(path)
+                self.assertEqual(backend.get('entry', 'key'), b'data')
+                backend.close()
+                backend = ultraimport.SQLiteCache(os.path.join(tmp_dir, 'missing.sqlite'))
+                self.assertIsNone(backend.get('entry', 'key'))
+                backend.close()
+            finally:
+                os.chmod(tmp_dir, 0o755)
+                os.chmod(path, 0o644)
+
+    def test_snapshot(self):
+        calls = []
+        def preprocessor(source, file_path=None):
+            calls.append(file_path)
+            return source + b'y = 2\n'
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            plain_file = f'{tmp_dir}{os.sep}plain.py'
+            snapshot_file = f'{tmp_dir}{os.sep}snapshot.bin'
+            with open(code_file, 'w') as f:
+                print('x = 1', file=f)
+            with open(plain_file, 'w') as f:
+                print('z = 3', file=f)
+
+            ultraimport(code_file, preprocessor=preprocessor, use_preprocessor_cache=False)
+            ultraimport(plain_file)
+            self.assertGreaterEqual(ultraimport.snapshot.save(snapshot_file), 2)
+
+            try:
+                self.assertGreaterEqual(ultraimport.snapshot.load(snapshot_file), 2)
+                calls.clear()
+                module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False, use_preprocessor_cache=False)
+                self.assertEqual((module.x, module.y), (1, 2))
+                self.assertEqual(ultraimport(plain_file, 'z', use_cache=False), 3)
+                self.assertEqual(calls, [], 'Code must be served from the snapshot')
+
+                # The source code is still available, e.g. for tracebacks, also with the preprocessor cache
+                self.assertEqual(module.__loader__.get_source(module.__name__), 'x = 1\ny = 2\n')
+                module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False)
+                self.assertEqual(module.__loader__.get_source(module.__name__), 'x = 1\ny = 2\n')
+                calls.clear()
+
+                # Changed source code invalidates the snapshot entry
+                with open(code_file, 'w') as f:
+                    print('x = 4', file=f)
+                module = ultraimport(code_file, preprocessor=preprocessor, use_cache=False, use_preprocessor_cache=False)
+                self.assertEqual((module.x, module.y), (4, 2))
+                self.assertEqual(len(calls), 1)
+            finally:
+                ultraimport.snapshot.close()
+
+    def test_recurse_resolves_at_rewrite_time(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(f'{tmp_dir}{os.sep}pkg{os.sep}sub')
+            with open(f'{tmp_dir}{os.sep}main.py', 'w') as f:
+                print('from .lib import value', file=f)
+                print('from .pkg.sub.mod import other', file=f)
+            with open(f'{tmp_dir}{os.sep}lib.py', 'w') as f:
+                print('value = 1', file=f)
+            with open(f'{tmp_dir}{os.sep}pkg{os.sep}sub{os.sep}mod.py', 'w') as f:
+                print('other = 2', file=f)
+
+            module = ultraimport(f'{tmp_dir}{os.sep}main.py', recurse=True, use_cache=False)
+            self.assertEqual((module.value, module.other), (1, 2))
+
+            with open(f'{tmp_dir}{os.sep}main__preprocessed__.py') as f:
+                preprocessed = f.read()
+            self.assertEqual(preprocessed.count('ultraimport.rewritten_import('), 2)
+            self.assertIn(repr(os.path.join(tmp_dir, 'lib.py')), preprocessed)
+            self.assertNotIn('__dir__', preprocessed)
+
+    def test_recurse_finds_files_created_later(self):
+        # The rewritten code is cached by source hash, so it must not depend on which files exist
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'pkg'))
+            with open(os.path.join(tmp_dir, 'pkg', '__init__.py'), 'w') as f:
+                pass
+            with open(os.path.join(tmp_dir, 'pkg', 'late_a.py'), 'w') as f:
+                print('from . import late_b', file=f)
+
+            with self.assertRaises(ultraimport.RewrittenImportError):
+                ultraimport(os.path.join(tmp_dir, 'pkg', 'late_a.py'), recurse=True, use_cache=False)
+
+            with open(os.path.join(tmp_dir, 'pkg', 'late_b.py'), 'w') as f:
+                print('value = 1', file=f)
+            module = ultraimport(os.path.join(tmp_dir, 'pkg', 'late_a.py'), recurse=True, use_cache=False)
+            self.assertEqual(module.late_b.value, 1)
+
+    def test_fast_path(self):
+        module = ultraimport('__dir__/../examples/myprogram/cache.py')
+
+        # Cache hits of the same call site must not walk the stack
+        find_caller = ultraimport.find_caller
+        ultraimport.find_caller = None
+        try:
+            for _ in range(2):
+                self.assertIs(ultraimport('__dir__/../examples/myprogram/cache.py'), module)
+        finally:
+            ultraimport.find_caller = find_caller
+
+    def test_fast_path_identical_code(self):
+        # Equal code objects in different directories must not share the resolved `__dir__`
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            modules = []
+            for name in ('one', 'two'):
+                os.makedirs(os.path.join(tmp_dir, name))
+                with open(os.path.join(tmp_dir, name, 'value.py'), 'w') as f:
+                    print(f'value = {name!r}', file=f)
+                with open(os.path.join(tmp_dir, name, f'importer_{name}.py'), 'w') as f:
+                    print('import ultraimport\ndef get(): return ultraimport("__dir__/value.py", "value")', file=f)
+                modules.append(ultraimport(os.path.join(tmp_dir, name, f'importer_{name}.py')))
+            self.assertEqual([ module.get() for module in modules ], [ 'one', 'two' ])
+            self.assertEqual([ module.get() for module in modules ], [ 'one', 'two' ])
+
+    def test_bind(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            with open(code_file, 'w') as f:
+                print('x = 1', file=f)
+
+            get_x = ultraimport.bind(code_file, 'x')
+            get_module = ultraimport.bind(code_file)
+            self.assertEqual(get_x(), 1)
+            self.assertEqual(get_module().x, 1)
+
+            # Changes of the module are visible
+            get_module().x = 2
+            self.assertEqual(get_x(), 2)
+
+            with self.assertRaises(ultraimport.ResolveImportError):
+                ultraimport.bind(code_file, 'missing')()
+
+    def test_stat_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = f'{tmp_dir}{os.sep}code.py'
+            new_file = f'{tmp_dir}{os.sep}new.py'
+            with open(code_file, 'w') as f:
+                print('x = 1', file=f)
+
+            for check_mtime in (True, False):
+                stat_cache = ultraimport.enable_stat_cache(check_mtime=check_mtime)
+                try:
+                    for _ in range(10):
+                        self.assertEqual(ultraimport(code_file, 'x', use_cache=False), 1)
+                    self.assertFalse(ultraimport.is_file(new_file))
+                    self.assertGreater(stat_cache.stats()['syscalls_saved'], 0)
+
+                    with open(new_file, 'w') as f:
+                        print('y = 2', file=f)
+                    if not check_mtime:
+                        self.assertFalse(ultraimport.is_file(new_file), 'Listings must be cached until invalidated')
+                        stat_cache.invalidate(tmp_dir)
+                    self.assertTrue(ultraimport.is_file(new_file))
+                    self.assertEqual(ultraimport(new_file, 'y', use_cache=False), 2)
+                finally:
+                    ultraimport.disable_stat_cache()
+                    if os.path.exists(new_file):
+                        os.remove(new_file)
+
+            with self.assertRaises(ultraimport.ResolveImportError):
+                ultraimport.enable_stat_cache()
+                try:
+                    ultraimport(new_file)
+                finally:
+                    ultraimport.disable_stat_cache()
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            outer_file = os.path.join(tmp_dir, 'outer.py')
+            inner_file = os.path.join(tmp_dir, 'inner.py')
+            with open(inner_file, 'w') as f:
+                print('import time; time.sleep(0.05)', file=f)
+            with open(outer_file, 'w') as f:
+                print(f'import ultraimport; ultraimport({inner_file!r})', file=f)
+
+            ultraimport.stats(reset=True)
+            ultraimport(outer_file, preprocessor=lambda source, *args, **kwargs: source)
+            ultraimport(outer_file, preprocessor=lambda source, *args, **kwargs: source)
+            stats = ultraimport.stats()
+
+            outer, inner = stats['files'][outer_file], stats['files'][inner_file]
+            self.assertGreaterEqual(inner['exec'], 0.05)
+            self.assertGreaterEqual(outer['cumulative'], inner['cumulative'])
+            self.assertLess(outer['self'], 0.05, 'Nested imports must not count as self time')
+            self.assertGreater(outer['preprocess'], 0)
+            self.assertGreater(outer['compile'], 0)
+            self.assertEqual(stats['counters']['cache_misses'], 2)
+            self.assertEqual(stats['counters']['cache_hits'], 1)
+            self.assertEqual(stats['counters']['preprocessor_cache_misses'], 1)
+            self.assertGreater(stats['counters']['stat_calls'], 0)
+
+            summary = ultraimport.import_stats.format()
+            self.assertLess(summary.index(outer_file), summary.index(inner_file), 'Summary must be sorted by cumulative time')
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            outer_file = os.path.join(tmp_dir, 'outer.py')
+            inner_file = os.path.join(tmp_dir, 'inner.py')
+            with open(inner_file, 'w') as f:
+                print('def hello(): return "hello"', file=f)
+            with open(outer_file, 'w') as f:
+                print(f'import ultraimport; hello = ultraimport({inner_file!r}, {{"hello": callable}}, lazy=True)', file=f)
+
+            ultraimport.start_trace()
+            hello = ultraimport(outer_file, 'hello', recurse=True)
+            self.assertEqual(hello(), 'hello')
+            tracer = ultraimport.stop_trace(os.path.join(tmp_dir, 'trace.json'))
+            self.assertIsNone(ultraimport.tracer)
+
+            with open(os.path.join(tmp_dir, 'trace.json')) as f:
+                chrome = json.load(f)
+            imports = { event['args']['file_path']: event for event in chrome['traceEvents'] if event['cat'] == 'import' }
+            self.assertFalse(imports[outer_file]['args']['lazy'])
+            self.assertTrue(imports[inner_file]['args']['lazy'])
+            self.assertIn('outer', imports[inner_file]['args']['caller_reference'])
+            phases = { event['name'] for event in chrome['traceEvents'] if event['cat'] == 'phase' }
+            self.assertTrue({ 'resolve', 'check', 'preprocess', 'compile', 'exec' } <= phases)
+
+            tracer.save(os.path.join(tmp_dir, 'trace.speedscope.json'))
+            with open(os.path.join(tmp_dir, 'trace.speedscope.json')) as f:
+                speedscope = json.load(f)
+            # Events must be properly nested
+            for profile in speedscope['profiles']:
+                stack = []
+                for event in profile['events']:
+                    if event['type'] == 'O':
+                        stack.append(event['frame'])
+                    else:
+                        self.assertEqual(stack.pop(), event['frame'])
+                self.assertEqual(stack, [])
+
+    def test_lean_import(self):
+        code = ('import sys, ultraimport; '
+                'print(sorted(set(sys.modules) & {"ast", "inspect", "traceback", "pathlib", "rich"}))')
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ret = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True)
+        self.assertEqual(ret.returncode, 0, ret.stderr)
+        self.assertEqual(ret.stdout.strip(), b'[]', 'Importing ultraimport must not import expensive modules')
+
+    def test_lazy_error_rendering(self):
+        renders = []
+        render = ultraimport.ResolveImportError.render
+        ultraimport.ResolveImportError.render = lambda self: renders.append(self) or render(self)
+        try:
+            error = ultraimport.ResolveImportError('File does not exist.', file_path='x.py', file_path_resolved='/x.py')
+            self.assertEqual(renders, [], 'Errors must only be rendered when needed')
+            self.assertIn('/x.py', str(error))
+            self.assertIn('File does not exist.', error.msg)
+            self.assertEqual(len(renders), 1, 'Errors must only be rendered once')
+        finally:
+            ultraimport.ResolveImportError.render = render
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'main.py'), 'w') as f:
+                print('from . import lib', file=f)
+                print('from .lib import *', file=f)
+                print('from .missing import nope', file=f)
+            with open(os.path.join(tmp_dir, 'lib.py'), 'w') as f:
+                print('value = 1', file=f)
+
+            with self.assertRaises(ultraimport.RewrittenImportError) as cm:
+                ultraimport(os.path.join(tmp_dir, 'main.py'), recurse=True, use_cache=False)
+            message = str(cm.exception)
+            self.assertIn('from .missing import nope', message)
+            self.assertIn(os.path.join(tmp_dir, 'missing.py'), message)
+            self.assertIn('File does not exist.', message)
+            self.assertTrue(all(type(probe) is ultraimport.ImportProbe for probe in cm.exception.combine))
+
+            namespace = { '__name__': 'main' }
+            lib = ultraimport.rewritten_import([ (os.path.join(tmp_dir, 'missing.py'), None), (os.path.join(tmp_dir, 'lib.py'), None) ])
+            self.assertEqual(lib.value, 1)
+            ultraimport.rewritten_import([ (os.path.join(tmp_dir, 'lib.py'), '*') ], add_to_ns=namespace)
+            self.assertEqual(namespace['value'], 1)
+
+            # Errors from nested imports must pass through load_module() without being rendered
+            with open(os.path.join(tmp_dir, 'outer.py'), 'w') as f:
+                print('import ultraimport', file=f)
+                print('ultraimport("__dir__/missing.py")', file=f)
+            with self.assertRaises(ultraimport.ResolveImportError) as cm:
+                ultraimport(os.path.join(tmp_dir, 'outer.py'), use_cache=False)
+            self.assertNotIn('_msg', cm.exception.__dict__)
+
+    def test_lazy_objects(self):
+        import threading
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = os.path.join(tmp_dir, 'lazy_objects.py')
+            with open(code_file, 'w') as f:
+                print('import time; time.sleep(0.1); loads = globals().get("loads", 0) + 1', file=f)
+                print('class Base: pass', file=f)
+                print('class Thing(Base): pass', file=f)
+                print('def make(): return Thing()', file=f)
+                print('VERSION = "1.0"', file=f)
+                print('LIMIT = 3', file=f)
+
+            namespace = { '__name__': 'test' }
+            ultraimport(code_file, { 'make': callable, 'Thing': type, 'Base': type, 'VERSION': str, 'LIMIT': int },
+                        add_to_ns=namespace, lazy=True)
+            self.assertIsInstance(namespace['make'], ultraimport.LazyCallable)
+            self.assertIs(ultraimport.LazyCass, ultraimport.LazyClass)
+
+            # Concurrent first calls load the module only once
+            results = []
+            threads = [ threading.Thread(target=lambda: results.append(namespace['make']())) for _ in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            module = sys.modules[ultraimport.get_unique_module_name(code_file)]
+            self.assertEqual(module.loads, 1)
+            self.assertEqual(len(results), 4)
+
+            # Replaced by the real objects in the namespace after first use
+            self.assertIs(namespace['make'], module.make)
+            lazy_thing, lazy_base = namespace['Thing'], namespace['Base']
+            self.assertIsInstance(results[0], lazy_thing)
+            self.assertTrue(issubclass(module.Thing, lazy_base))
+            self.assertTrue(issubclass(lazy_thing, module.Base))
+            self.assertIs(namespace['Thing'], module.Thing)
+
+            class Sub(namespace['Base']):
+                pass
+            self.assertTrue(issubclass(Sub, module.Base))
+
+            version, limit = namespace['VERSION'], namespace['LIMIT']
+            self.assertEqual(version, '1.0')
+            self.assertEqual(f'v{version}', 'v1.0')
+            self.assertIsInstance(version, str)
+            self.assertEqual(limit + 1, 4)
+            self.assertEqual(2 * limit, 6)
+            self.assertEqual(list(range(limit)), [0, 1, 2])
+            self.assertEqual(namespace['VERSION'], '1.0')
+
+            with self.assertRaises(TypeError):
+                ultraimport(code_file, { 'LIMIT': str }, lazy=True) + 'x'
+
+    def test_lazy_module(self):
+        import threading, types
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            code_file = os.path.join(tmp_dir, 'lazy_module.py')
+            with open(code_file, 'w') as f:
+                print('import time; time.sleep(0.1); loads = globals().get("loads", 0) + 1', file=f)
+                print('def hello(): return "hello"', file=f)
+
+            module = ultraimport(code_file, lazy=True)
+            self.assertIs(type(module), ultraimport.LazyModule)
+            self.assertIs(sys.modules[ultraimport.get_unique_module_name(code_file)], module)
+            # Importing it again returns the same lazy module
+            self.assertIs(ultraimport(code_file, {}, lazy=True), module)
+
+            # Concurrent first accesses execute the module only once
+            results = []
+            threads = [ threading.Thread(target=lambda: results.append(module.hello())) for _ in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, ['hello'] * 4)
+            self.assertEqual(module.loads, 1)
+
+            # The lazy module has become the real module
+            self.assertIs(type(module), types.ModuleType)
+            self.assertIs(sys.modules[module.__name__], module)
+            self.assertIs(ultraimport(code_file), module)
+            self.assertIs(module.hello.__globals__, module.__dict__)
+
+    def test_finder(self):
+        import importlib
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            package_dir = os.path.join(tmp_dir, 'src')
+            os.makedirs(os.path.join(package_dir, 'plugins'))
+            with open(os.path.join(package_dir, '__init__.py'), 'w') as f:
+                print('from . import sub', file=f)
+            with open(os.path.join(package_dir, 'sub.py'), 'w') as f:
+                print('from .helper import VALUE', file=f)
+            with open(os.path.join(package_dir, 'helper.py'), 'w') as f:
+                print('VALUE = "original"', file=f)
+            with open(os.path.join(package_dir, 'plugins', 'plugin.py'), 'w') as f:
+                print('from .. import helper', file=f)
+
+            preprocessor = lambda source, file_path: source.replace(b'original', b'preprocessed')
+            finder = ultraimport.install_finder({ 'finderapp': package_dir, 'org.finderapp': package_dir },
+                                                preprocessor=preprocessor, use_preprocessor_cache=False)
+            try:
+                self.assertIs(sys.meta_path[0], finder)
+                import finderapp
+                self.assertEqual(finderapp.sub.VALUE, 'preprocessed')
+                self.assertEqual(finderapp.__path__, [ package_dir ])
+
+                # Directories without __init__ file are namespace packages
+                from finderapp.plugins import plugin
+                self.assertIs(plugin.helper, finderapp.helper)
+
+                # Parents of mapped names are namespace packages
+                import org.finderapp.sub
+                self.assertEqual(org.finderapp.sub.VALUE, 'preprocessed')
+
+                with self.assertRaises(ModuleNotFoundError):
+                    import finderapp.late
+
+                # Modules added later are found as well
+                with open(os.path.join(package_dir, 'late.py'), 'w') as f:
+                    print('VALUE = "original"', file=f)
+                import finderapp.late
+                self.assertEqual(finderapp.late.VALUE, 'preprocessed')
+                self.assertIn('finderapp.late', finder.locations)
+                importlib.invalidate_caches()
+                self.assertEqual(finder.locations, {})
+            finally:
+                ultraimport.uninstall_finder(finder)
+                for name in list(sys.modules):
+                    if name.split('.')[0] in ('finderapp', 'org'):
+                        del sys.modules[name]
+            self.assertNotIn(finder, sys.meta_path)
+
+    def test_manifest(self):
+        import importlib
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            first_file, outer_file, inner_file, skipped_file = (os.path.join(tmp_dir, f'{name}.py')
+                                                                for name in ('first', 'outer', 'inner', 'skipped'))
+            manifest_file = os.path.join(tmp_dir, 'manifest.json')
+            with open(first_file, 'w') as f:
+                print('x = 1', file=f)
+            with open(outer_file, 'w') as f:
+                print('import ultraimport; inner = ultraimport("__dir__/inner.py")', file=f)
+            with open(inner_file, 'w') as f:
+                print('y = 2', file=f)
+            with open(skipped_file, 'w') as f:
+                print('w = 4', file=f)
+            # Recorded preprocessors must be importable by name, also when the tests run as `__main__`
+            with open(os.path.join(tmp_dir, 'manifest_preprocessors.py'), 'w') as f:
+                print('def add_z(source, file_path=None):\n    return source + b"z = 3\\n"', file=f)
+
+            sys.path.insert(0, tmp_dir)
+            try:
+                add_z = importlib.import_module('manifest_preprocessors').add_z
+                ultraimport.manifest.start()
+                ultraimport(first_file, preprocessor=add_z, use_preprocessor_cache=False)
+                ultraimport(outer_file)
+                # Preprocessors that cannot be found by name are not recorded
+                ultraimport(skipped_file, preprocessor=lambda source, file_path=None: source, use_preprocessor_cache=False)
+                self.assertEqual(ultraimport.manifest.save(manifest_file), 3)
+                ultraimport.manifest.stop()
+
+                with open(manifest_file) as f:
+                    entries = json.load(f)['imports']
+                # Recorded in the order the imports started
+                self.assertEqual([ entry['file_path'] for entry in entries ], [ first_file, outer_file, inner_file ])
+                self.assertEqual(entries[0]['preprocessor'], 'manifest_preprocessors:add_z')
+
+                for file_path in (first_file, outer_file, inner_file):
+                    del ultraimport.cache[(file_path, None)]
+
+                # The next run prepares all files ahead and the imports take them
+                self.assertEqual(ultraimport.manifest.prefetch(manifest_file), 3)
+                self.assertEqual(len(ultraimport.prefetched), 3)
+                module = ultraimport(first_file, preprocessor=add_z, use_preprocessor_cache=False)
+                self.assertEqual((module.x, module.z), (1, 3))
+                self.assertEqual(ultraimport(outer_file).inner.y, 2)
+                self.assertEqual(len(ultraimport.prefetched), 0)
+
+                # A missing manifest is not an error
+                self.assertEqual(ultraimport.manifest.prefetch(os.path.join(tmp_dir, 'missing.json')), 0)
+            finally:
+                ultraimport.manifest.stop()
+                sys.path.remove(tmp_dir)
+                sys.modules.pop('manifest_preprocessors', None)
+
+    def test_compile_command(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'sub'))
+            main_file = os.path.join(tmp_dir, 'main.py')
+            with open(main_file, 'w') as f:
+                print('from .sub.mod import x', file=f)
+            with open(os.path.join(tmp_dir, 'sub', 'mod.py'), 'w') as f:
+                print('x = 1', file=f)
+
+            env = os.environ.copy()
+            env['PYTHONPATH'] = os.path.dirname(__file__) + os.path.sep + '../'
+            command = [ sys.executable, '-m', 'ultraimport', 'compile', '--recurse', tmp_dir ]
+            ret = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            self.assertEqual(ret.returncode, 0, ret.stderr)
+            self.assertIn(b'Compiled 2 files, 0 failed', ret.stdout)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'main__preprocessed__.py')))
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'sub', 'mod__preprocessed__.py')))
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir, '__pycache__'))), 1)
+
+            # The import finds the preprocessed file
+            with open(os.path.join(tmp_dir, 'main__preprocessed__.py')) as f:
+                preprocessed = f.read()
+            self.assertEqual(ultraimport(main_file, 'x', recurse=True), 1)
+            with open(os.path.join(tmp_dir, 'main__preprocessed__.py')) as f:
+                self.assertEqual(f.read(), preprocessed)
+
+            # Any failure gives a nonzero exit code
+            with open(os.path.join(tmp_dir, 'broken.py'), 'w') as f:
+                print('def broken(:', file=f)
+            ret = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            self.assertEqual(ret.returncode, 1)
+            self.assertIn(b'broken.py: SyntaxError', ret.stderr)
+
+    def test_watch(self):
+        import threading
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            watched_file, other_file = (os.path.join(tmp_dir, f'{name}.py') for name in ('watched', 'other'))
+            with open(watched_file, 'w') as f:
+                print('value = 1', file=f)
+            with open(other_file, 'w') as f:
+                print('import ultraimport; watched = ultraimport("__dir__/watched.py"); loads = globals().get("loads", 0) + 1', file=f)
+            other = ultraimport(other_file)
+            watched = other.watched
+
+            # Polling
+            watcher = ultraimport.Watcher(use_inotify=False, callback=lambda results: None)
+            watcher.sync()
+            self.assertEqual(watcher.poll(), [])
+            with open(watched_file, 'w') as f:
+                print('value = 22', file=f)
+            os.utime(watched_file, ns=(0, 10**9))
+            results = watcher.poll()
+            self.assertEqual([ (file_path, error) for file_path, duration, error in results ], [ (watched_file, None) ])
+            # Reloaded in place, other modules are not executed again
+            self.assertEqual(watched.value, 22)
+            self.assertIs(ultraimport(watched_file), watched)
+            self.assertEqual(other.loads, 1)
+
+            # Errors are reported, the module keeps working
+            with open(watched_file, 'w') as f:
+                print('value = ', file=f)
+            os.utime(watched_file, ns=(0, 2 * 10**9))
+            (file_path, duration, error), = watcher.poll()
+            self.assertIsInstance(error, SyntaxError)
+            self.assertEqual(watched.value, 22)
+
+            # Background thread, with inotify where available
+            reloaded = threading.Event()
+            watcher = ultraimport.watch(interval=0.05, callback=lambda results: reloaded.set())
+            try:
+                with open(watched_file, 'w') as f:
+                    print('value = 333', file=f)
+                os.utime(watched_file, ns=(0, 3 * 10**9))
+                self.assertTrue(reloaded.wait(5))
+                self.assertEqual(watched.value, 333)
+            finally:
+                watcher.stop()
+
+    def test_invalidate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = { name: os.path.join(tmp_dir, f'{name}.py') for name in ('base', 'mid', 'top', 'other', 'unrelated') }
+            with open(files['base'], 'w') as f:
+                print('value = 1', file=f)
+            for name, imported in (('mid', 'base'), ('top', 'mid'), ('other', 'base')):
+                with open(files[name], 'w') as f:
+                    print(f'import ultraimport; {imported} = ultraimport("__dir__/{imported}.py")', file=f)
+            with open(files['unrelated'], 'w') as f:
+                print('value = 2', file=f)
+            # Relative imports rewritten with recurse=True are recorded as well
+            with open(os.path.join(tmp_dir, 'relative.py'), 'w') as f:
+                print('from .base import value', file=f)
+
+            top, other, unrelated = (ultraimport(files[name]) for name in ('top', 'other', 'unrelated'))
+            relative = ultraimport(os.path.join(tmp_dir, 'relative.py'), recurse=True)
+            base = top.mid.base
+
+            self.assertEqual(ultraimport.get_dependents(files['base'], cascade=False),
+                             [ files['mid'], files['other'], os.path.join(tmp_dir, 'relative.py') ])
+            self.assertEqual(ultraimport.get_dependents(files['mid']), [ files['top'] ])
+
+            # Only the file itself
+            self.assertEqual(ultraimport.invalidate(files['base'], cascade=False), [ files['base'] ])
+            self.assertIsNot(ultraimport(files['base']), base)
+            self.assertIs(ultraimport(files['mid']), top.mid)
+
+            # The file and everything depending on it
+            evicted = ultraimport.invalidate(files['base'])
+            self.assertEqual(set(evicted), { files['base'], files['mid'], files['top'], files['other'], os.path.join(tmp_dir, 'relative.py') })
+            self.assertNotIn(ultraimport.get_unique_module_name(files['base']), sys.modules)
+            self.assertNotIn((files['top'], None), ultraimport.cache)
+            self.assertIs(ultraimport(files['unrelated']), unrelated)
+            self.assertIsNot(ultraimport(files['top']), top)
+            self.assertIsNot(ultraimport(files['other']), other)
+
+            # The preprocessed code is evicted from every kind of preprocessor cache
+            calls = []
+            def preprocessor(source, file_path=None):
+                calls.append(file_path)
+                return source
+            options = [
+                {},
+                { 'use_code_cache': True },
+                { 'cache_backend': ultraimport.MemoryCache() },
+                { 'cache_backend': ultraimport.DirectoryCache(os.path.join(tmp_dir, 'cache')) },
+                { 'use_code_cache': True, 'cache_backend': ultraimport.SQLiteCache(os.path.join(tmp_dir, 'cache.sqlite')) },
+            ]
+            preprocessed = os.path.join(tmp_dir, 'preprocessed.py')
+            with open(preprocessed, 'w') as f:
+                print('value = 3', file=f)
+            for kwargs in options:
+                calls.clear()
+                ultraimport(preprocessed, preprocessor=preprocessor, **kwargs)
+                ultraimport.invalidate(preprocessed)
+                ultraimport(preprocessed, preprocessor=preprocessor, **kwargs)
+                self.assertEqual(len(calls), 2, f'The preprocessor cache must be evicted for {kwargs}')
+                ultraimport.invalidate(preprocessed)
+            options[-1]['cache_backend'].close()
+
+    def test_unload_and_limit_cache(self):
+        import gc, weakref
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plugin_files = [ os.path.join(tmp_dir, f'plugin{i}.py') for i in range(4) ]
+            for i, file_path in enumerate(plugin_files):
+                with open(file_path, 'w') as f:
+                    print(f'def run(): return {i}', file=f)
+
+            module = ultraimport(plugin_files[0], package='plugins')
+            self.assertIs(sys.modules['plugins'].plugin0, module)
+            self.assertEqual(ultraimport.unload(plugin_files[0]), 1)
+            self.assertNotIn((plugin_files[0], 'plugins'), ultraimport.cache)
+            self.assertNotIn(ultraimport.get_unique_module_name(plugin_files[0]), sys.modules)
+            self.assertNotIn('plugins.plugin0', sys.modules)
+            self.assertFalse(hasattr(sys.modules['plugins'], 'plugin0'))
+
+            # Nothing in ultraimport keeps the module alive
+            reference = weakref.ref(module)
+            del module
+            gc.collect()
+            self.assertIsNone(reference())
+
+            # Modules imported without cache are found in `sys.modules`
+            ultraimport(plugin_files[1], use_cache=False)
+            self.assertEqual(ultraimport.unload(plugin_files[1]), 1)
+            self.assertNotIn(ultraimport.get_unique_module_name(plugin_files[1]), sys.modules)
+            self.assertEqual(ultraimport.unload(plugin_files[1]), 0)
+
+            evicted = []
+            cache, ultraimport.cache = ultraimport.cache, {}
+            try:
+                ultraimport.limit_cache(2, on_evict=lambda file_path, module: evicted.append(file_path))
+                ultraimport.stats(reset=True)
+                first, second = (ultraimport(file_path) for file_path in plugin_files[:2])
+                # Using a module keeps it in the cache
+                self.assertIs(ultraimport(plugin_files[0]), first)
+                ultraimport(plugin_files[2])
+                self.assertEqual(evicted, [ plugin_files[1] ])
+                self.assertNotIn(ultraimport.get_unique_module_name(plugin_files[1]), sys.modules)
+                self.assertEqual(ultraimport.stats()['counters']['cache_evictions'], 1)
+                self.assertIsNot(ultraimport(plugin_files[1]), second)
+                self.assertEqual(evicted, [ plugin_files[1], plugin_files[0] ])
+            finally:
+                ultraimport.cache = cache
+
+            # Lazy modules that are evicted before their first use still load when they are used
+            cache, ultraimport.cache = ultraimport.cache, {}
+            try:
+                ultraimport.limit_cache(1)
+                lazy = ultraimport(plugin_files[3], lazy=True)
+                ultraimport(plugin_files[2])
+                self.assertNotIn((plugin_files[3], None), ultraimport.cache)
+                self.assertEqual(lazy.run(), 3)
+                self.assertIs(type(lazy), type(sys))
+
+                lazy = ultraimport(plugin_files[0], lazy=True)
+                self.assertIs(type(lazy), ultraimport.LazyModule)
+                ultraimport.invalidate(plugin_files[0])
+                self.assertEqual(lazy.run(), 0)
+                self.assertIs(type(lazy), type(sys))
+            finally:
+                ultraimport.cache = cache
+
+        # Another thread evicts the module while it is looked up
+        class RacingCache(ultraimport.BoundedCache):
+            def move_to_end(self, key, last=True):
+                super().move_to_end(key, last)
+                self.pop(key)
+        racing_cache = RacingCache(2, entries=[ ('key', 'module') ])
+        self.assertEqual(racing_cache.get('key'), 'module')
+        self.assertIsNone(racing_cache.get('key'))
+
+        # Nothing is kept per file path after unloading
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lib_file = os.path.join(tmp_dir, 'per_path_lib.py')
+            main_file = os.path.join(tmp_dir, 'per_path_main.py')
+            with open(lib_file, 'w') as f:
+                print('value = 1', file=f)
+            with open(main_file, 'w') as f:
+                print('import ultraimport; lib = ultraimport("__dir__/per_path_lib.py", package="per_path")', file=f)
+
+            def per_path_data(file_path):
+                return { 'stats': file_path in ultraimport.import_stats.files,
+                         'dependents': file_path in ultraimport.dependents,
+                         'packages': any(key[0] == file_path for key in ultraimport.resolved_packages),
+                         'memo': any(key[0] == file_path for key in ultraimport.resolved_cache_keys.values()) }
+
+            ultraimport(main_file)
+            self.assertEqual(per_path_data(lib_file), dict.fromkeys(('stats', 'dependents', 'packages', 'memo'), True))
+            self.assertEqual(ultraimport.unload(lib_file), 1)
+            self.assertEqual(ultraimport.unload(main_file), 1)
+            for file_path in (lib_file, main_file):
+                self.assertFalse(any(per_path_data(file_path).values()), file_path)
+
+    def test_unique_module_names(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_paths = [ os.path.join(tmp_dir, *parts, 'uniq_utils.py') for parts in (('a',), ('b',), ('x', 'b')) ]
+            for i, file_path in enumerate(file_paths):
+                os.makedirs(os.path.dirname(file_path))
+                with open(file_path, 'w') as f:
+                    print(f'value = {i}', file=f)
+            # Names of other modules in `sys.modules` are not taken over either
+            os.makedirs(os.path.join(tmp_dir, 'std'))
+            json_file = os.path.join(tmp_dir, 'std', 'json.py')
+            with open(json_file, 'w') as f:
+                print('value = "json"', file=f)
+
+            # Names only depend on the path, not on the import order or the process
+            names = [ ultraimport.get_unique_module_name(file_path) for file_path in reversed(file_paths) ][::-1]
+            modules = [ ultraimport(file_path) for file_path in file_paths ]
+            self.assertEqual([ module.__name__ for module in modules ], names)
+            self.assertEqual(len(set(names)), 3)
+            self.assertTrue(all(name.startswith('uniq_utils_') for name in names))
+            for module in modules:
+                self.assertIs(sys.modules[module.__name__], module)
+            code = f'import ultraimport; print(ultraimport.get_unique_module_name({file_paths[1]!r}))'
+            env = os.environ.copy()
+            env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            ret = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True)
+            self.assertEqual(ret.stdout.decode().strip(), names[1])
+
+            # Even if the standard library module has not been imported yet
+            sys.modules.pop('json', None)
+            try:
+                self.assertTrue(ultraimport(json_file).__name__.startswith('json_'))
+                self.assertNotIn('json', sys.modules)
+            finally:
+                sys.modules['json'] = json
+
+            # Lookup by path, names stay the same when a file is imported again
+            self.assertIs(ultraimport.find_existing_module_by_path(file_paths[1]), modules[1])
+            ultraimport.unload(file_paths[1])
+            self.assertIsNone(ultraimport.find_existing_module_by_path(file_paths[1]))
+            self.assertEqual(ultraimport(file_paths[1]).__name__, names[1])
+
     # TODO
     #def test_lazy_load(self):
     #    pass
@@ -103,12 +1063,31 @@ class ultraimportTests(unittest.TestCase):
             f"Namespace package has unexpected path: {sys.modules['test_ns_package_one.test_ns_package_two'].__path__}")
         tmp_dir.cleanup()
 
+    def test_reuse_namespace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for dir_name in ('a', 'b'):
+                os.makedirs(os.path.join(tmp_dir, dir_name))
+                with open(os.path.join(tmp_dir, dir_name, f'mod_{dir_name}.py'), 'w') as f:
+                    print(f'value = {dir_name!r}', file=f)
+
+            mod_a = ultraimport(os.path.join(tmp_dir, 'a', 'mod_a.py'), package='test_reuse_ns.sub')
+            package = sys.modules['test_reuse_ns.sub']
+            mod_b = ultraimport(os.path.join(tmp_dir, 'b', 'mod_b.py'), package='test_reuse_ns.sub')
+
+            self.assertIs(sys.modules['test_reuse_ns.sub'], package, 'Package must be reused')
+            self.assertIs(package.mod_a, mod_a, 'Earlier sibling must stay attached')
+            self.assertIs(package.mod_b, mod_b)
+            self.assertIs(sys.modules['test_reuse_ns'].sub, package)
+            self.assertEqual(list(package.__path__), [ os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b') ])
+            self.assertEqual(mod_b.__package__, 'test_reuse_ns.sub')
+
     @unittest.skipUnless(sys.version_info >= (3, 9), "requires Python >= 3.9")
     def test_example_mypackage(self):
         file_path = "examples/mypackage/run.py"
         ret = self.exec(file_path)
         self.assertEqual(ret.returncode, 0, f'Running {file_path} did return with an error: {ret}')
-        self.assertEqual(ret.stdout, b"submodule start  submodule\n"
+        name = ultraimport.get_unique_module_name(os.path.abspath(f"{os.path.dirname(__file__)}{os.sep}..{os.sep}examples/mypackage/somepackage/subpackage/submodule.py"))
+        self.assertEqual(ret.stdout, f"submodule start  {name}\n".encode() +
             b"hello from xmodule.py\n"
             b"somepackage.__init__ start\n"
             b"somepackage.__init__ end\n"
@@ -19,7 +19,10 @@
 #
 
 import importlib, importlib.machinery, importlib.util
-import ast, collections, contextlib, inspect, os, pathlib, sys, types, traceback, time
+import collections, contextlib, marshal, operator, os, sys, threading, types, time, weakref
+
+# Note: Modules like `ast`, `inspect`, `traceback` and `rich` are comparably expensive to import and only needed
+#       for rewriting imports or for rendering errors, so they are imported when needed.
 
 # Explicit ultraimport overrides win over terminal heuristics.
 FORCE_COLORS = os.environ.get('ULTRAIMPORT_COLORS', '').lower() in {'1', 'true', 'yes', 'on'}
@@ -36,7 +39,8 @@ PLAIN_TEXT_MODE = not FORCE_COLORS and (
 
 # If possible, let's print nice exceptions via rich. Rich tracebacks are colored and
 # boxed, so plain mode keeps the stock Python traceback instead.
-if not PLAIN_TEXT_MODE:
+def rich_excepthook(exc_type, exc_value, exc_traceback, previous_excepthook=sys.excepthook):
+    """ Installs rich only when the first uncaught exception is rendered, so importing ultraimport stays fast """
     try:
         from rich.console import Console
         from rich.traceback import install
@@ -45,19 +49,62 @@ if not PLAIN_TEXT_MODE:
         # install() builds by default, tracebacks go to stderr.
         install(show_locals=False, console=Console(stderr=True, force_terminal=FORCE_COLORS or None))
     except:
-        pass
+        sys.excepthook = previous_excepthook
+    sys.excepthook(exc_type, exc_value, exc_traceback)
+
+if not PLAIN_TEXT_MODE:
+    sys.excepthook = rich_excepthook
 
-__all__ = ['ultraimport']
+__all__ = ['ultraimport', 'import_many', 'bind', 'stats', 'start_trace', 'stop_trace', 'enable_stat_cache', 'disable_stat_cache', 'start_preprocessor_pool', 'stop_preprocessor_pool',
+           'install_finder', 'uninstall_finder', 'CacheBackend', 'MemoryCache', 'DirectoryCache', 'SQLiteCache', 'snapshot', 'manifest', 'watch', 'invalidate', 'unload', 'limit_cache']
 
 # Keep track of reload count
 reload_counter = 0
 
 # Dict of loaded files, the keys are tuples of two
-# input parameters of the ultraimport() function: file_path and the package parameter
+# input parameters of the ultraimport() function: file_path and the package parameter.
+# Modules are only added after they have been executed completely, except lazy modules, see LazyModule.
+# It is replaced by a BoundedCache if limit_cache() is used.
 cache = {}
 
-# Keep track of ongoing imports to detect circular imports
-import_ongoing_stack = {}
+# Keep track of ongoing imports per thread to detect circular imports
+import_ongoing = threading.local()
+
+# Per resolved file path locks, so threads importing the same file wait for each other
+import_locks = {}
+
+# Maps thread ids to the ImportLock the thread is waiting for, used to detect deadlocks
+import_lock_waiters = {}
+
+# Guards `import_locks` and compound updates of `cache`
+global_lock = threading.RLock()
+
+# Packages resolved by get_package_name(): (file_path, package) -> (package name, package path, package module)
+resolved_packages = {}
+
+# Registry of modules loaded by ultraimport: resolved file path -> latest module loaded from it
+modules_by_path = {}
+
+# Reverse dependency graph: resolved file path -> set of resolved file paths of the files that import it
+dependents = {}
+
+# Lazy modules that have not been executed yet, mapped to their loading state, see LazyModule. A lazy module that
+# has been unloaded keeps its state, so references that are still held somewhere can load it later.
+lazy_modules = weakref.WeakKeyDictionary()
+
+# Cache for file system checks, see enable_stat_cache()
+stat_cache = None
+
+# Process pool for running preprocessors, see start_preprocessor_pool()
+preprocessor_pool = None
+
+# Memo for the fast path of ultraimport(). The keys are tuples of the call site (code object of the caller or
+# the `caller` parameter), its file name, the file_path and the package parameter, the values are keys of `cache`.
+resolved_cache_keys = {}
+
+# Futures of loaders that have been prepared ahead of time by import_many(), the keys are
+# tuples of the resolved file_path and all parameters that influence the loader
+prefetched = {}
 
 # Print debug output, especially for code transformation
 debug = False
@@ -68,7 +115,8 @@ if debug:
     import astprettier
 
 def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=None, package=None, caller=None, caller_reference=None,
-                use_cache=True, lazy=False, recurse=False, inject=None, use_preprocessor_cache=True, cache_path_prefix=None):
+                use_cache=True, lazy=False, recurse=False, inject=None, use_preprocessor_cache=True, cache_path_prefix=None,
+                use_code_cache=False, cache_backend=None):
     """
     Import Python code files from the file system. This is the central main function of ultraimport.
 
@@ -93,6 +141,9 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
 
         preprocessor (callable): Takes the source code as an argument and can return a modified version of the source code.
             Check out the [debug-transform example](/examples/working/debug-transform) on how to use the preprocessor.
+            Preprocessed files are cached based on a hash of the source code and a fingerprint of the preprocessor. Set a
+            `version` or `cache_key` attribute on your preprocessor to control when cached files become invalid,
+            otherwise a hash of the preprocessor's code is used.
 
         package (str | int): Can have several modes depending on if you provide a string or an integer. If you provide
             a string, ultraimport will generate one or more namespace packages and use it as parent package of your
@@ -111,8 +162,11 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
             Otherwise a cached version of the imported module is returned.
 
         lazy (bool): *Experimental* *wip* If set to `True` and if `objects_to_import` is set to `None`, it will lazy
-            import the module. If set to True and `objects_to_import` is a dict, the values of the dict must be the
-            type of the object to lazy import from the module. Currently only the type `callable` is supported.
+            import the module. The module is executed on first attribute access and then becomes a regular module
+            object. If set to True and `objects_to_import` is a dict, the values of the dict must be the
+            type of the object to lazy import from the module. Use `callable` for functions, `type` for classes or
+            any other type for constants and other objects. Lazy objects are replaced by the real objects in
+            `add_to_ns` when they are used for the first time.
 
         recurse (bool): If set to `True`, a built-in preprocessor is activated to transparently rewrite all relative
             import statements (those with a dot like `from . import something`) to ultraimport() calls. Use this mode
@@ -130,6 +184,15 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
             preprocessed files will always look like they are in the same directory as the original source code files,
             even if they are not.
 
+        use_code_cache (bool): If set to `True`, the preprocessor cache stores the compiled code object of the
+            preprocessed module instead of the preprocessed source code. A cached module is then loaded with a single
+            read and `marshal.loads()`, without the detour of reading, compiling and caching the preprocessed file
+            as a regular source file.
+
+        cache_backend (CacheBackend): Store preprocessed files or code objects in a cache backend instead of files
+            next to the source code files. Built-in backends are `MemoryCache`, `DirectoryCache` and `SQLiteCache`.
+            This is useful for read-only or network file systems.
+
     Returns:
         Depending on the parameters *returns one of the following*:
 
@@ -146,6 +209,22 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
     if debug:
         print("ultraimport", file_path)
 
+    # Fast path for modules in the cache: We remember the resolved cache key per call site, so we neither have to walk
+    # the stack nor resolve the file path again. Relative paths without `__dir__` depend on the working directory.
+    memo_key = None
+    if use_cache and not lazy and add_to_ns is not True and ('__dir__' in file_path or os.path.isabs(file_path)):
+        call_site = caller or get_caller_code()
+        if call_site:
+            # Code objects of identical code in different files are equal, so the file name must be part of the key
+            memo_key = (call_site, getattr(call_site, 'co_filename', None), file_path, package)
+            cache_key = resolved_cache_keys.get(memo_key)
+            if cache_key:
+                module = cache.get(cache_key)
+                if module is not None:
+                    import_stats.counters['cache_hits'] += 1
+                    return import_objects(module, objects_to_import, add_to_ns, file_path, cache_key[0])
+
+    started = time.perf_counter()
     file_path_orig = file_path
 
     # If we are in Cython compiled code, there are not frames for what happens inside ultraimport
@@ -163,33 +242,58 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
         else:
             raise Exception('No frame found to inject imported objects')
 
-    if '__dir__' in file_path:
-        file_path = file_path.replace('__dir__', os.path.dirname(caller))
-
-    file_path = os.path.abspath(file_path)
-
-    if lazy and (type(objects_to_import) == dict):
+    file_path = resolve_file_path(file_path, caller)
+    import_stats.add(file_path, 'resolve', started)
 
-        if not caller_reference:
-            caller_reference = f"{frame.f_code.co_filename}:{frame.f_lineno}"
+    if lazy and not caller_reference:
+        caller_reference = f"{frame.f_code.co_filename}:{frame.f_lineno}"
 
-        # Lazy load the whole module
-        if not objects_to_import:
-            importer = lambda: ultraimport(file_path_orig, caller=caller, caller_reference=caller_reference, use_cache=use_cache)
-            name = get_module_name(file_path)
-            module = LazyModule(name, file_path, importer=importer)
-            sys.modules[name] = module
-            return module
+    # Lazy load the whole module
+    if lazy and not objects_to_import and (objects_to_import is None or type(objects_to_import) == dict):
+        cache_key = (file_path, package)
+        module = cache.get(cache_key) if use_cache else None
+        if module is None:
+            def load(module):
+                import_ongoing_stack = get_import_ongoing_stack()
+                if file_path in import_ongoing_stack:
+                    raise CircularImportError(file_path=file_path_orig, file_path_resolved=file_path)
+                if import_ongoing_stack:
+                    add_dependency(file_path, next(reversed(import_ongoing_stack)))
+                import_ongoing_stack[file_path] = True
+                try:
+                    with import_lock(file_path, file_path_orig), \
+                         import_stats.measure(file_path, time.perf_counter(), caller_reference):
+                        load_module(file_path, file_path_orig, package, preprocessor, recurse, inject, caller_reference,
+                                    use_preprocessor_cache, cache_path_prefix, use_code_cache, cache_backend, module=module)
+                except BaseException:
+                    # A failed module is not cached, the next import starts from scratch
+                    if cache.get(cache_key) is module:
+                        del cache[cache_key]
+                    raise
+                finally:
+                    import_ongoing_stack.pop(file_path, None)
+
+            with import_lock(file_path, file_path_orig):
+                module = cache.get(cache_key) if use_cache else None
+                if module is None:
+                    module_name = get_unique_module_name(file_path)
+                    module = LazyModule(module_name, file_path, load)
+                    sys.modules[module_name] = modules_by_path[file_path] = module
+                    # The lazy module becomes the real module in place, so it can be cached right away
+                    if use_cache:
+                        cache[cache_key] = module
+        return module
 
-        # Lazy load individual objects from the module
+    # Lazy load individual objects from the module
+    if lazy:
         if type(objects_to_import) == dict:
             # Construct lambda function that allows to load the desired file later on
             importer = lambda: ultraimport(file_path_orig, caller=caller, caller_reference=caller_reference, use_cache=use_cache)
+            # Lazy objects replace themselves in the namespace they were added to
+            namespace = add_to_ns if isinstance(add_to_ns, dict) else None
             for item, item_type in objects_to_import.items():
-                if item_type == callable:
-                    objects_to_import[item] = LazyCallable(importer=importer, callable_name=item)
-                else:
-                    raise Exception("Only types 'callable' and 'module' are supported")
+                objects_to_import[item] = get_lazy_class(item_type)(importer, item, expected_type=item_type, namespace=namespace,
+                                                                      file_path=file_path_orig, file_path_resolved=file_path)
 
             if add_to_ns:
                 add_to_ns.update(objects_to_import)
@@ -201,141 +305,606 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
         else:
             raise Exception("When setting lazy=True the parameter objects_to_import must be a dict.")
 
+    import_ongoing_stack = get_import_ongoing_stack()
+
     if file_path in import_ongoing_stack:
         # TODO: Come up with better error message how to handle circular import errors
         raise CircularImportError(file_path=file_path_orig, file_path_resolved=file_path)
 
+    if import_ongoing_stack:
+        add_dependency(file_path, next(reversed(import_ongoing_stack)))
+
     with contextlib.ExitStack() as cleaner:
         cleaner.callback(import_ongoing_stack.pop, file_path, None)
 
         import_ongoing_stack[file_path] = True
 
-
-        #print('CACHE CHECK', use_cache, file_path, file_path in cache)
-        #print('CACHE', cache)
-
         cache_key = (file_path, package)
 
+        # Lock-free fast path, `cache` only ever contains completely executed modules or lazy modules that execute
+        # themselves on first access
         # TODO: Should we use resolved file_path for the cache?
-        if use_cache and cache_key in cache:
-            module = cache[cache_key]
-        else:
-            check_file_is_importable(file_path, file_path_orig, caller_reference)
-            name = get_module_name(file_path)
+        module = cache.get(cache_key) if use_cache else None
+
+        if module is None:
+            # Other threads importing the same file wait here until the first one is done
+            cleaner.enter_context(import_lock(file_path, file_path_orig))
+            # Another thread might have finished the import while we were waiting
+            module = cache.get(cache_key) if use_cache else None
+
+        if module is None:
+            import_stats.counters['cache_misses'] += 1
+            cleaner.enter_context(import_stats.measure(file_path, started, caller_reference))
+
+            module = load_module(file_path, file_path_orig, package, preprocessor, recurse, inject, caller_reference,
+                                 use_preprocessor_cache, cache_path_prefix, use_code_cache, cache_backend)
 
-            # If we want to recruse, we need to add our recurse preprocessor
-            # to any other preprocessors from the user
-            preprocessor_combined = preprocessor
-            if recurse:
-                def _(source, *args, **kwargs):
-                    if preprocessor:
-                        source = preprocessor(source, *args, **kwargs)
-                    return RewriteImport.transform_imports(source, *args, **kwargs)
-                preprocessor_combined = _
-
-            package_name, package_path, package_module = get_package_name(file_path, package)
-
-            # Long name of the module including parent package if available
-            full_name = f'{package_name}.{name}' if package_name else name
-
-            loader = Loader(full_name, file_path, preprocessor=preprocessor_combined, use_cache=use_preprocessor_cache, cache_path_prefix=cache_path_prefix)
-            spec = importlib.util.spec_from_loader(full_name, loader)
-            spec.origin = file_path
-            spec.has_location = True
-
-            module = importlib.util.module_from_spec(spec)
-
-            # Inject ultraimport module
-            module.ultraimport = sys.modules[__name__]
-
-            # Inject other dependencies
-            if inject:
-                for k, v in inject.items():
-                    # We skip all internal keys with double underscore
-                    if not k.startswith('__'):
-                        setattr(module, k, v)
-
-            #print('__package__', package_name)
-            #print('__path__', package_path)
-            #print('module', module)
-            if package_name:
-                module.__package__ = package_name
-                # Inject module into the package
-                setattr(package_module, name, module)
-
-            sys.modules[name] = module
             if use_cache:
                 cache[cache_key] = module
+        else:
+            import_stats.counters['cache_hits'] += 1
+
+    if memo_key:
+        resolved_cache_keys[memo_key] = cache_key
+
+    return import_objects(module, objects_to_import, add_to_ns, file_path_orig, file_path)
+
+def load_module(file_path, file_path_orig, package, preprocessor, recurse, inject, caller_reference,
+                use_preprocessor_cache, cache_path_prefix, use_code_cache, cache_backend, module=None):
+    """
+    Create and execute the module for the resolved `file_path`. Parameters are the same as for ultraimport(). If a
+    `module` is given, the code is executed in that existing module object.
+    """
+    check_started = time.perf_counter()
+    check_file_is_importable(file_path, file_path_orig, caller_reference)
+    import_stats.add(file_path, 'check', check_started)
+    name = get_module_name(file_path)
+    # Name in `sys.modules`, unlike `name` it is unique for every file path
+    module_name = get_unique_module_name(file_path, name)
+
+    package_name, package_path, package_module = get_package_name(file_path, package)
+
+    # Long name of the module including parent package if available
+    full_name = f'{package_name}.{name}' if package_name else module_name
+
+    if manifest.recording:
+        manifest.add(file_path, package, preprocessor, recurse, use_preprocessor_cache, cache_path_prefix, use_code_cache,
+                     cache_backend)
+
+    loader = None
+    if prefetched:
+        loader = get_prefetched_loader((file_path, package, preprocessor, recurse, use_preprocessor_cache, cache_path_prefix,
+                                        use_code_cache, cache_backend))
+
+    if loader:
+        loader.name = full_name
+    else:
+        preprocessor_combined = combine_preprocessor(preprocessor, recurse)
+        code_object = snapshot.get_code(file_path, package, preprocessor_combined) if snapshot.entries else None
+        loader = Loader(full_name, file_path, preprocessor=preprocessor_combined,
+                        use_cache=use_preprocessor_cache, cache_path_prefix=cache_path_prefix, use_code_cache=use_code_cache,
+                        cache_backend=cache_backend, code_object=code_object)
+    spec = importlib.util.spec_from_loader(full_name, loader)
+    spec.origin = file_path
+    spec.has_location = True
+
+    if module is None:
+        module = importlib.util.module_from_spec(spec)
+    else:
+        # A lazy module is turned into the real module in place
+        module.__dict__.update(importlib.util.module_from_spec(spec).__dict__)
+
+    # Inject ultraimport module
+    module.ultraimport = sys.modules[__name__]
+
+    # Inject other dependencies
+    if inject:
+        for k, v in inject.items():
+            # We skip all internal keys with double underscore
+            if not k.startswith('__'):
+                setattr(module, k, v)
+
+    #print('__package__', package_name)
+    #print('__path__', package_path)
+    #print('module', module)
+    if package_name:
+        module.__package__ = package_name
+        # Inject module into the package
+        setattr(package_module, name, module)
+
+    sys.modules[module_name] = modules_by_path[file_path] = module
 
+    try:
+        exec_started = time.perf_counter()
+        get_code_time = getattr(loader, 'get_code_time', 0)
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            # Compiling and preprocessing are accounted for by the loader
+            import_stats.add(file_path, 'exec', exec_started, excluded=getattr(loader, 'get_code_time', 0) - get_code_time)
+    except ImportError as e:
+        # If the import fails, we do not cache the module
+        if sys.modules.get(module_name) is module:
+            del sys.modules[module_name]
+        if modules_by_path.get(file_path) is module:
+            del modules_by_path[file_path]
+
+        # TODO: Move all the error case handling to the exception classes directly
+        #print(e.msg, e.name, e.path)
+        if isinstance(e, ErrorRendererMixin):
+            # Our own errors are already specific and rendering their message is costly, so pass them on as they are
+            raise e
+        if (e.msg == 'attempted relative import with no known parent package' or
+            e.msg == 'attempted relative import beyond top-level package'):
+            if recurse:
+                raise ImportError('This is an internal ultraimport error. Please report this bug and the circumstances!')
+            if package:
+                raise ExecuteImportError('Wrongly handled, relative import statement found.', file_path=file_path_orig, file_path_resolved=file_path, from_exception=e).with_traceback(e.__traceback__) from None
+            else:
+                raise ExecuteImportError('Unhandled, relative import statement found.', file_path=file_path_orig, file_path_resolved=file_path, from_exception=e).with_traceback(e.__traceback__) from None
+        if (e.msg.startswith('cannot import name') and e.msg.endswith('(unknown location)')):
+                raise ExecuteImportError(str(e), file_path=file_path_orig, file_path_resolved=file_path, from_exception=e).with_traceback(e.__traceback__) from None
+        else:
+            raise e
+
+    return module
+
+def import_objects(module, objects_to_import, add_to_ns, file_path_orig, file_path):
+    """ Return the module or the `objects_to_import` from it as described in ultraimport() and update `add_to_ns` """
+    if objects_to_import:
+        return_single = False
+        return_zipped = False
+        if objects_to_import == '*':
+            objects_to_import = [ item for item in dir(module) if not item.startswith('__') ]
+            return_zipped = True
+        elif type(objects_to_import) == str:
+            objects_to_import = [ objects_to_import ]
+            return_single = True
+
+        values = []
+        for item in objects_to_import:
             try:
-                spec.loader.exec_module(module)
-            except ImportError as e:
-                # If the import fails, we do not cache the module
-                if cache_key in cache:
-                    del cache[cache_key]
-                if name in sys.modules:
-                    del sys.modules[name]
-
-                # TODO: Move all the error case handling to the exception classes directly
-                #print(e.msg, e.name, e.path)
-                if (e.msg == 'attempted relative import with no known parent package' or
-                    e.msg == 'attempted relative import beyond top-level package'):
-                    if recurse:
-                        raise ImportError('This is an internal ultraimport error. Please report this bug and the circumstances!')
-                    if package:
-                        raise ExecuteImportError('Wrongly handled, relative import statement found.', file_path=file_path_orig, file_path_resolved=file_path, from_exception=e).with_traceback(e.__traceback__) from None
-                    else:
-                        raise ExecuteImportError('Unhandled, relative import statement found.', file_path=file_path_orig, file_path_resolved=file_path, from_exception=e).with_traceback(e.__traceback__) from None
-                if (e.msg.startswith('cannot import name') and e.msg.endswith('(unknown location)')):
-                        raise ExecuteImportError(str(e), file_path=file_path_orig, file_path_resolved=file_path, from_exception=e).with_traceback(e.__traceback__) from None
-                else:
-                    raise e
-
-        if objects_to_import:
-            return_single = False
-            return_zipped = False
-            if objects_to_import == '*':
-                objects_to_import = [ item for item in dir(module) if not item.startswith('__') ]
-                return_zipped = True
-            elif type(objects_to_import) == str:
-                objects_to_import = [ objects_to_import ]
-                return_single = True
-
-            values = []
-            for item in objects_to_import:
-                try:
-                    attr = getattr(module, item)
-                    # When it's a dict, we expect the types of the imports to be the values
-                    if (type(objects_to_import) == dict):
-                        if not isinstance(attr, objects_to_import[item]):
-                            raise TypeError(f"Import type mismatch, expected '{item}' to be of type {objects_to_import[item]} but got {type(attr)}")
-                    values.append(getattr(module, item))
-                except AttributeError as e:
-                    raise ResolveImportError(str(e), file_path=file_path_orig, file_path_resolved=file_path) from None
-
-            if add_to_ns or return_zipped:
-                zipped = dict(zip(objects_to_import, values))
+                attr = getattr(module, item)
+                # When it's a dict, we expect the types of the imports to be the values
+                if (type(objects_to_import) == dict):
+                    if not isinstance(attr, objects_to_import[item]):
+                        raise TypeError(f"Import type mismatch, expected '{item}' to be of type {objects_to_import[item]} but got {type(attr)}")
+                values.append(getattr(module, item))
+            except AttributeError as e:
+                raise ResolveImportError(str(e), file_path=file_path_orig, file_path_resolved=file_path) from None
+
+        if add_to_ns or return_zipped:
+            zipped = dict(zip(objects_to_import, values))
+
+        if add_to_ns:
+            add_to_ns.update(zipped)
+
+        if return_single:
+            return values[0]
+
+        if return_zipped:
+            return zipped
+
+        return values
+    # If there are no `objects_to_import`, it means we should import the whole module.
+    # If `add_to_ns` is set, we must add it to this namespace.
+    # TODO: Check that add_to_ns can take key/value pairs.
+    elif add_to_ns:
+        add_to_ns[module.__name__] = module
 
-            if add_to_ns:
-                add_to_ns.update(zipped)
+    if debug:
+        print('module:', module)
 
-            if return_single:
-                return values[0]
+    return module
 
-            if return_zipped:
-                return zipped
+def rewritten_import(candidates, code_info=None, caller=None, add_to_ns=None):
+    """
+    Import an object from the first candidate file that provides it. Relative import statements are rewritten
+    to calls of this function when using `recurse=True`.
 
-            return values
-        # If there are no `objects_to_import`, it means we should import the whole module.
-        # If `add_to_ns` is set, we must add it to this namespace.
-        # TODO: Check that add_to_ns can take key/value pairs.
-        elif add_to_ns:
-            add_to_ns[module.__name__] = module
+    Candidates are probed without raising exceptions, an error is only raised if none of them works.
 
-        if debug:
-            print('module:', module)
+    Parameters:
+        candidates (Iterable[Tuple[str, str]]): Tuples of file path and name of the object to import. If the
+            name is `None`, the module itself is imported. The name `'*'` imports all objects into `add_to_ns`.
+        code_info (CodeInfo): Location of the original import statement for error messages
+        caller (str): File system path to the file of the calling module
+        add_to_ns (Dict[str, object]): Namespace to add the objects to when the name is `'*'`
 
-        return module
+    Returns:
+        The imported object or module
+    """
+    probes = []
+    object_name = None
+    for file_path, object_name in candidates:
+        file_path_resolved = resolve_file_path(file_path, caller) if caller else os.path.abspath(file_path)
+
+        module = cache.get((file_path_resolved, None))
+        if module is not None:
+            import_ongoing_stack = get_import_ongoing_stack()
+            if import_ongoing_stack:
+                add_dependency(file_path_resolved, next(reversed(import_ongoing_stack)))
+        else:
+            exists, isfile, readable = file_status(file_path_resolved)
+            reason = None
+            if not exists:
+                reason = 'File does not exist.'
+            elif not isfile:
+                reason = 'Object exists but is not a file.'
+            elif not readable:
+                reason = 'File exists but no read access.'
+            if reason:
+                probes.append(ImportProbe(file_path, file_path_resolved, reason))
+                continue
+
+            module = ultraimport(file_path_resolved, recurse=True, caller=caller or file_path_resolved)
+
+        if object_name is None:
+            return module
+        if object_name == '*':
+            return import_objects(module, '*', add_to_ns, file_path, file_path_resolved)
+
+        try:
+            return getattr(module, object_name)
+        except AttributeError as e:
+            probes.append(ImportProbe(file_path, file_path_resolved, str(e)))
+
+    raise RewrittenImportError(code_info=code_info, combine=probes, object_to_import=object_name)
+
+def bind(file_path, object_name=None, caller=None, **kwargs):
+    """
+    Bind an import to an accessor function. The first call of the accessor imports the file, any further call
+    returns the object with a single dict lookup. Use this in hot code paths, e.g. request handlers.
+
+    Parameters:
+        file_path (str): Path to the module file, see ultraimport().
+
+        object_name (str): Name of the object to return from the module. If `None`, the accessor returns the module.
+
+        caller (str): Can be set `caller=__file__` to save some CPU cycles. Otherwise it will be derived from the current
+            stack.
+
+        **kwargs: Any other parameters of ultraimport(), e.g. `package` or `recurse`.
+
+    Returns:
+        callable: Accessor function without parameters returning the module or object
+    """
+    if not caller:
+        caller = find_caller()
+
+    namespace = {}
+    key = object_name
+
+    def resolve():
+        nonlocal namespace, key
+        module = ultraimport(file_path, caller=caller, **kwargs)
+        if object_name is None:
+            namespace, key = { None: module }, None
+        elif object_name in vars(module):
+            # We keep the namespace and not the object itself, so later changes of the module are visible
+            namespace = vars(module)
+        else:
+            raise ResolveImportError(f"Module '{module.__name__}' has no attribute '{object_name}'", file_path=file_path,
+                                     file_path_resolved=module.__file__)
+        return namespace[key]
+
+    def accessor():
+        try:
+            return namespace[key]
+        except KeyError:
+            return resolve()
+
+    return accessor
+
+def import_many(imports, caller=None, max_workers=None, **kwargs):
+    """
+    Import many files at once. The caller is only resolved once and reading, preprocessing and compiling of all
+    files is done in parallel on a thread pool. The modules are still executed one after the other in the given
+    order, so the result is the same as calling ultraimport() for every file in turn.
+
+    Parameters:
+        imports (Iterable[str | Tuple[str, object]]): Paths of the files to import. Instead of a path, an item can
+            also be a tuple of a path and the `objects_to_import` parameter for this file.
+
+        caller (str): Can be set `caller=__file__` to save some CPU cycles. Otherwise it will be derived from the current
+            stack.
+
+        max_workers (int): Maximum number of threads used to prepare the files. Defaults to the default of
+            `concurrent.futures.ThreadPoolExecutor`.
+
+        **kwargs: Any other parameters of ultraimport(), e.g. `package`, `preprocessor` or `recurse`. They are used
+            for all files.
+
+    Returns:
+        list: The return values of the ultraimport() calls in the same order as `imports`.
+    """
+    import concurrent.futures
+
+    if not caller:
+        caller = find_caller()
+
+    items = [ (item, None) if isinstance(item, str) else tuple(item) for item in imports ]
+
+    package = kwargs.get('package')
+    preprocessor = kwargs.get('preprocessor')
+    recurse = kwargs.get('recurse', False)
+    use_cache = kwargs.get('use_cache', True)
+    use_preprocessor_cache = kwargs.get('use_preprocessor_cache', True)
+    cache_path_prefix = kwargs.get('cache_path_prefix')
+    use_code_cache = kwargs.get('use_code_cache', False)
+    cache_backend = kwargs.get('cache_backend')
+
+    keys = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        try:
+            for file_path, _ in items:
+                file_path = resolve_file_path(file_path, caller)
+                if use_cache and (file_path, package) in cache:
+                    continue
+                key = (file_path, package, preprocessor, recurse, use_preprocessor_cache, cache_path_prefix, use_code_cache, cache_backend)
+                if key in prefetched:
+                    continue
+                keys.append(key)
+                prefetched[key] = executor.submit(prefetch_loader, file_path, preprocessor=combine_preprocessor(preprocessor, recurse),
+                                                  use_cache=use_preprocessor_cache, cache_path_prefix=cache_path_prefix,
+                                                  use_code_cache=use_code_cache, cache_backend=cache_backend)
+
+            return [ ultraimport(file_path, objects_to_import, caller=caller, **kwargs) for file_path, objects_to_import in items ]
+        finally:
+            # Loaders of failed or skipped imports are not needed anymore
+            for key in keys:
+                future = prefetched.pop(key, None)
+                if future:
+                    future.cancel()
+
+############
+# SNAPSHOT #
+############
+
+class Snapshot:
+    """
+    Freeze the code of all modules imported in a run into a single file. Later processes load this file and
+    execute the stored code objects instead of reading, preprocessing and compiling every file again, similar to
+    frozen modules in CPython. Entries are only used if the hash of the source file and the preprocessor still match.
+
+    Use the instance `ultraimport.snapshot`, e.g. call `ultraimport.snapshot.save(path)` at the end of a run and
+    `ultraimport.snapshot.load(path)` early in later runs.
+    """
+
+    signature = b'ULTRAIMPORT-SNAPSHOT\n' + importlib.util.MAGIC_NUMBER
+
+    def __init__(self):
+        self.entries = {}
+        self.buffer = None
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path):
+        """
+        Write the code objects of all modules in `ultraimport.cache` to the file `path`.
+
+        Returns:
+            int: Number of modules in the snapshot
+        """
+        index = {}
+        blobs = []
+        offset = 0
+        for (file_path, package), module in list(cache.items()):
+            loader = getattr(module, '__loader__', None)
+            if not isinstance(loader, SourceFileLoader):
+                continue
+
+            try:
+                with open(file_path, 'rb') as f:
+                    source_hash = get_source_hash(f.read())
+            except OSError:
+                # The file has been removed in the meantime
+                continue
+            fingerprint = get_preprocessor_fingerprint(loader.preprocessor) if loader.preprocessor else None
+            blob = marshal.dumps(loader.get_code(module.__name__))
+
+            index[(file_path, package)] = (source_hash, fingerprint, offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+
+        index = marshal.dumps(index)
+        write_file_atomic(path, b''.join([self.signature, len(index).to_bytes(8, 'little'), index] + blobs))
+
+        return len(blobs)
+
+    def load(self, path):
+        """
+        Serve imports from the snapshot file `path`. The file is memory-mapped, code objects are only unmarshalled
+        when they are imported.
+
+        Returns:
+            int: Number of modules in the snapshot
+        """
+        import mmap
+
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        start = len(self.signature)
+        if buffer[:start] != self.signature:
+            buffer.close()
+            raise ValueError(f"File '{path}' is not an ultraimport snapshot of this Python version")
+
+        index_size = int.from_bytes(buffer[start:start + 8], 'little')
+        start += 8
+        entries = marshal.loads(buffer[start:start + index_size])
+        start += index_size
+
+        with global_lock:
+            self.close()
+            self.buffer = buffer
+            # Translate offsets, so they point directly into the buffer
+            self.entries = { key: (source_hash, fingerprint, start + offset, size)
+                             for key, (source_hash, fingerprint, offset, size) in entries.items() }
+
+        return len(self.entries)
+
+    def get_code(self, file_path, package, preprocessor):
+        """ Return the code object for a file or `None` if the snapshot has no valid entry for it """
+        entry = self.entries.get((file_path, package))
+        if entry:
+            source_hash, fingerprint, offset, size = entry
+            try:
+                with open(file_path, 'rb') as f:
+                    valid = get_source_hash(f.read()) == source_hash
+            except OSError:
+                valid = False
+
+            if valid and fingerprint == (get_preprocessor_fingerprint(preprocessor) if preprocessor else None):
+                self.hits += 1
+                return marshal.loads(self.buffer[offset:offset + size])
+
+        self.misses += 1
+        return None
+
+    def close(self):
+        """ Stop serving imports from the snapshot """
+        with global_lock:
+            self.entries = {}
+            if self.buffer:
+                self.buffer.close()
+                self.buffer = None
+
+snapshot = Snapshot()
+
+############
+# MANIFEST #
+############
+
+class Manifest:
+    """
+    Record which files a run imports and replay this on the next start. The files are then read, preprocessed and
+    compiled on background threads ahead of the main thread, which finds the prepared code in memory when it
+    reaches the import.
+
+    Use the instance `ultraimport.manifest`, e.g. call `ultraimport.manifest.start()` early in a run,
+    `ultraimport.manifest.save(path)` at the end and `ultraimport.manifest.prefetch(path)` early in later runs.
+    Set the environment variable `ULTRAIMPORT_MANIFEST` to a file path to do all of this automatically.
+
+    Only imports that can be repeated in another process are recorded. Preprocessors must be importable by name
+    and imports with a `cache_backend` are skipped.
+    """
+
+    version = 1
+
+    def __init__(self):
+        self.recording = False
+        # Prefetch key -> manifest entry, in the order the imports started
+        self.entries = {}
+        # Prefetch keys scheduled by prefetch()
+        self.scheduled = []
+
+    def start(self):
+        """ Start recording imports """
+        with global_lock:
+            self.entries = {}
+            self.recording = True
+
+    def add(self, file_path, package, preprocessor, recurse, use_preprocessor_cache, cache_path_prefix, use_code_cache,
+            cache_backend):
+        """ Record an import, called by ultraimport() when a file is loaded """
+        if cache_backend is not None or not isinstance(package, (str, int, type(None))):
+            return
+        reference = get_object_reference(preprocessor) if preprocessor else None
+        if preprocessor and not reference:
+            return
+
+        key = (file_path, package, reference, recurse, use_preprocessor_cache, cache_path_prefix, use_code_cache)
+        with global_lock:
+            self.entries.setdefault(key, {
+                'file_path': file_path,
+                'package': package,
+                'preprocessor': reference,
+                'recurse': recurse,
+                'use_preprocessor_cache': use_preprocessor_cache,
+                'cache_path_prefix': cache_path_prefix,
+                'use_code_cache': use_code_cache,
+            })
+
+    def save(self, path):
+        """
+        Write the recorded imports to the file `path`.
+
+        Returns:
+            int: Number of files in the manifest
+        """
+        import json
+
+        with global_lock:
+            entries = list(self.entries.values())
+        write_file_atomic(path, json.dumps({ 'version': self.version, 'imports': entries }, indent=1).encode())
+
+        return len(entries)
+
+    def prefetch(self, path, max_workers=None):
+        """
+        Prepare the imports listed in the manifest file `path` on a thread pool, in the order they were recorded.
+        A missing or outdated manifest is not an error, files that cannot be prepared are imported as usual.
+
+        Parameters:
+            path (str): Path of a manifest written by save()
+            max_workers (int): Maximum number of threads, see `concurrent.futures.ThreadPoolExecutor`
+
+        Returns:
+            int: Number of files scheduled for prefetching
+        """
+        import concurrent.futures
+        import json
+
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return 0
+        if data.get('version') != self.version:
+            return 0
+
+        count = 0
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='ultraimport-prefetch')
+        try:
+            for entry in data['imports']:
+                file_path, package = entry['file_path'], entry['package']
+                if (file_path, package) in cache:
+                    continue
+                # Preprocessors are resolved here, so they are the same objects the imports will use
+                preprocessor = resolve_object_reference(entry['preprocessor']) if entry['preprocessor'] else None
+                if entry['preprocessor'] and not preprocessor:
+                    continue
+
+                key = (file_path, package, preprocessor, entry['recurse'], entry['use_preprocessor_cache'],
+                       entry['cache_path_prefix'], entry['use_code_cache'], None)
+                with global_lock:
+                    if key in prefetched:
+                        continue
+                    prefetched[key] = executor.submit(prefetch_loader, file_path,
+                                                      preprocessor=combine_preprocessor(preprocessor, entry['recurse']),
+                                                      use_cache=entry['use_preprocessor_cache'],
+                                                      cache_path_prefix=entry['cache_path_prefix'],
+                                                      use_code_cache=entry['use_code_cache'])
+                    self.scheduled.append(key)
+                    count += 1
+        finally:
+            # Threads exit when the queue is done
+            executor.shutdown(wait=False)
+
+        return count
+
+    def stop(self):
+        """ Stop recording and drop prefetched files that have not been imported """
+        with global_lock:
+            self.recording = False
+            for key in self.scheduled:
+                future = prefetched.pop(key, None)
+                if future:
+                    future.cancel()
+            self.scheduled = []
+
+manifest = Manifest()
 
 ##################
 # ERROR HANDLING #
@@ -344,8 +913,47 @@ def ultraimport(file_path, objects_to_import=None, add_to_ns=None, preprocessor=
 # TODO: Switch to internal Python code info object
 CodeInfo = collections.namedtuple('CodeInfo', ['source', 'file_path', 'line', 'offset'])
 
+class FrameInfo(collections.namedtuple('FrameInfo', ['filename', 'lineno', 'name'])):
+    """ Location of a stack frame, the source code line is only read when needed """
+
+    @property
+    def line(self):
+        import linecache
+        return linecache.getline(self.filename, self.lineno).strip()
+
+def get_external_frame(depth=1):
+    """ Return the FrameInfo of the innermost frame outside of ultraimport and importlib or `None` """
+    frame = sys._getframe(depth)
+    while frame and (frame.f_code.co_filename == __file__ or '<frozen importlib._bootstrap' in frame.f_code.co_filename):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return FrameInfo(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
 class ErrorRendererMixin():
-    """ Mixin for Exception classes with some helper functions, mainly for rendering data to console """
+    """
+    Mixin for Exception classes with some helper functions, mainly for rendering data to console.
+
+    Errors only collect some facts when they are raised, the message is rendered by `render()` when it is needed.
+    Many errors are raised and caught without ever being shown, e.g. when probing files.
+    """
+
+    def __str__(self):
+        return self.msg
+
+    @property
+    def msg(self):
+        msg = self.__dict__.get('_msg')
+        if msg is None:
+            msg = self._msg = self.render()
+        return msg
+
+    @msg.setter
+    def msg(self, msg):
+        self._msg = msg
+
+    def render(self):
+        return ''
 
     def render_table(self, data):
         """
@@ -382,48 +990,49 @@ class ErrorRendererMixin():
     def render_suggestion(self, line1, line2):
         return f"\n ╲ {line1}\n ╱ {line2}\n"
 
-    def find_frame(self, frames, depth=1):
-        while True:
-            try:
-                frame = frames[0 - depth]
-                depth += 1
-                if frame.filename == __file__ or '<frozen importlib._bootstrap' in frame.filename:
-                    continue
-            except IndexError as exc:
-                break
-            return frame
-
-class RewrittenImportError(ImportError, ErrorRendererMixin):
+class RewrittenImportError(ErrorRendererMixin, ImportError):
     def __init__(self, message='', combine=None, code_info=None, object_to_import=None, *args, **kwargs):
 
         super().__init__('')
 
         if combine and len(combine) > 0:
             for e in combine:
-                if type(e) is not ResolveImportError:
+                if type(e) is not ResolveImportError and type(e) is not ImportProbe:
                     raise AttributeError(f"Type of combined exceptions in 'combine' attribute must be 'ultraimport.Error', but it was '{type(e)}'")
 
         if not combine or (len(combine) < 1):
             raise AttributeError("Missing errors of rewritten imports in 'combine' attribute")
 
+        if code_info and type(code_info) is not CodeInfo:
+            code_info = CodeInfo(*code_info)
+
+        self.combine = combine
+        self.code_info = code_info
+        self.object_to_import = object_to_import
+
+        # Location in the preprocessed source file, either from the exception being handled or from the caller
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        if exc_traceback:
+            self.frame = FrameInfo(exc_traceback.tb_frame.f_code.co_filename, exc_traceback.tb_lineno, exc_traceback.tb_frame.f_code.co_name)
+        else:
+            self.frame = get_external_frame(2)
+
+    def render(self):
         error_table = []
+        code_info = self.code_info
         if code_info:
-            if type(code_info) is not CodeInfo:
-                code_info = CodeInfo(*code_info)
-
             error_table.extend([
                 ('Original source file', f"'{code_info.file_path}', line {code_info.line}:{code_info.offset}"),
                 ('Original source code', code_info.source),
             ])
 
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        frame = traceback.extract_tb(exc_traceback)[0]
-        error_table.extend([
-            ('Preprocessed source file', f"{frame.filename}:{frame.lineno}"),
-        ])
+        if self.frame:
+            error_table.extend([
+                ('Preprocessed source file', f"{self.frame.filename}:{self.frame.lineno}"),
+            ])
 
-        error_table.append(('Error details', f"Could not find resource '{object_to_import}' in any of the following files:"))
-        for e in combine:
+        error_table.append(('Error details', f"Could not find resource '{self.object_to_import}' in any of the following files:"))
+        for e in self.combine:
             error_table.append(('', f'- {e.file_path_resolved}'))
             error_table.append(('', f'  (Possible reason: {e.reason})'))
 
@@ -433,50 +1042,37 @@ class RewrittenImportError(ImportError, ErrorRendererMixin):
         suggestion = self.render_suggestion('Check if the required package or module really exists in your file system.',
             'If you know the path but cannot change the import statement, use dependency injection to inject the resource.')
 
-        self.msg = f"{header}\n{body}{suggestion}"
-
-    def find_cause(self, tb=None, depth=0):
-        frame = None
-        while True:
-            try:
-                frame = sys._getframe(depth)
-                depth += 1
-                if frame.f_code.co_filename == __file__ or '<frozen importlib._bootstrap' in frame.f_code.co_filename:
-                    continue
-            except ValueError as exc:
-                break
-        return frame
+        return f"{header}\n{body}{suggestion}"
 
-class CircularImportError(ImportError, ErrorRendererMixin):
+class CircularImportError(ErrorRendererMixin, ImportError):
     def __init__(self, message=None, file_path=None, file_path_resolved=None, *args):
 
         super().__init__()
 
-        header = self.render_header('Circular Import Error', 'An unresolved circular import was detected while importing a file.')
-
-        error_table = []
-        suggestion = ''
+        self.file_path = file_path
+        self.file_path_resolved = file_path_resolved
+        self.frame = get_external_frame(2)
 
-        #import pprint
-        #pprint.pprint(traceback.extract_stack())
+    def render(self):
+        header = self.render_header('Circular Import Error', 'An unresolved circular import was detected while importing a file.')
 
-        frame = self.find_frame(frames=traceback.extract_stack())
-        error_table.extend([
+        frame = self.frame
+        error_table = [
             ('Source file', f"{frame.filename}:{frame.lineno}"),
             ('Happend in', frame.name),
             ('Source code', frame.line),
-            ('Import file_path', file_path),
-            ('Resolved file_path', file_path_resolved),
-        ])
+            ('Import file_path', self.file_path),
+            ('Resolved file_path', self.file_path_resolved),
+        ]
 
         suggestion = self.render_suggestion('You can use the ultraimport() parameter `lazy=True` to resolve circular dependencies.',
             'This will only actually load imported modules and callables when they are used for the first time.')
 
         body = self.render_table(error_table)
 
-        self.msg = f"{header}\n{body}{suggestion}"
+        return f"{header}\n{body}{suggestion}"
 
-class ExecuteImportError(ImportError, ErrorRendererMixin):
+class ExecuteImportError(ErrorRendererMixin, ImportError):
     def __init__(self, message=None, file_path=None, file_path_resolved=None, from_exception=None, depth=2, *args, **kwargs):
 
         super().__init__()
@@ -486,10 +1082,14 @@ class ExecuteImportError(ImportError, ErrorRendererMixin):
         self.file_path_resolved = file_path_resolved
         # Store the original reason/message for later
         self.reason = message
+        self.from_exception = from_exception
 
+    def render(self):
         header = self.render_header('Execute Import Error', 'An import file could be found and read, but an error happened while executing it.')
         suggestion = ''
 
+        from_exception = self.from_exception
+        import traceback
         frame = traceback.extract_tb(from_exception.__traceback__)[-1]
         error_table = [
             ('Source file', f"{frame.filename}:{frame.lineno}"),
@@ -511,9 +1111,9 @@ class ExecuteImportError(ImportError, ErrorRendererMixin):
         error_table.append(('Original error', f'"{from_exception.msg}"'))
         body = self.render_table(error_table)
 
-        self.msg = f"{header}\n{body}{suggestion}"
+        return f"{header}\n{body}{suggestion}"
 
-class ResolveImportError(ImportError, ErrorRendererMixin):
+class ResolveImportError(ErrorRendererMixin, ImportError):
     def __init__(self, message=None, file_path=None, file_path_resolved=None, from_exception=None, caller_reference=None, *args, **kwargs):
 
         super().__init__()
@@ -523,12 +1123,14 @@ class ResolveImportError(ImportError, ErrorRendererMixin):
         self.file_path_resolved = file_path_resolved
         # Store the original reason/message for later
         self.reason = message
+        self.caller_reference = caller_reference
+        self.frame = get_external_frame(2)
 
+    def render(self):
         header = self.render_header('Resolve Import Error', 'An import file could not be found or not be read.')
 
-        #frame = traceback.extract_stack()
-        #print('FRAMES', frame)
-        frame = self.find_frame(frames=traceback.extract_stack())
+        frame = self.frame
+        file_path, file_path_resolved = self.file_path, self.file_path_resolved
         error_table = [
             ('Source file', f"{frame.filename}:{frame.lineno}"),
             ('Happend in', frame.name),
@@ -538,10 +1140,9 @@ class ResolveImportError(ImportError, ErrorRendererMixin):
             ('Possible reason', self.reason)
         ]
 
-        if caller_reference:
-            error_table.insert(0, ('Lazy loaded', caller_reference))
+        if self.caller_reference:
             error_table = [
-                ('Source file', caller_reference),
+                ('Source file', self.caller_reference),
                 ('Lazy loading triggered', f"{frame.filename}:{frame.lineno}"),
                 ('Happend in', frame.name),
                 ('Source code', frame.line),
@@ -563,179 +1164,1379 @@ class ResolveImportError(ImportError, ErrorRendererMixin):
 
         body = self.render_table(error_table)
 
-        self.msg = f"{header}\n{body}{suggestion}"
+        return f"{header}\n{body}{suggestion}"
 
+# Result of probing a candidate file of a rewritten import that could not be imported, see rewritten_import().
+# Unlike ResolveImportError, it is cheap to create.
+ImportProbe = collections.namedtuple('ImportProbe', ['file_path', 'file_path_resolved', 'reason'])
 
 ################
 # LAZY LOADING #
 ################
 
-class LazyCass():
-    """ Lazily-loaded class that triggers module loading on access """
+class LazyObject():
+    """
+    Lazily-loaded object that triggers module loading on first use and then behaves like the loaded object.
 
-    # TODO: https://stackoverflow.com/questions/61942205/lazy-class-factory
-    pass
+    The object is loaded only once, even if several threads use it at the same time. Afterwards, the lazy object
+    replaces itself in the `namespace` it was added to, so later lookups get the real object without any detour.
+    """
+
+    __slots__ = ('_importer', '_name', '_expected_type', '_namespace', '_file_path', '_file_path_resolved', '_lock', '_target')
 
-class LazyCallable():
-    """ Lazily-loaded callable that triggers module loading on access """
-    def __init__(self, importer, callable_name):
+    def __init__(self, importer, name, expected_type=None, namespace=None, file_path=None, file_path_resolved=None):
         self._importer = importer
-        self._callable_name = callable_name
+        self._name = name
+        self._expected_type = expected_type
+        self._namespace = namespace
+        self._file_path = file_path
+        self._file_path_resolved = file_path_resolved
+        # Reentrant, so an import that uses the object while it is loading ends in a CircularImportError
+        self._lock = threading.RLock()
+
+    def _load(self):
+        try:
+            return self._target
+        except AttributeError:
+            pass
+
+        with self._lock:
+            # Another thread might have loaded it while we were waiting
+            try:
+                return self._target
+            except AttributeError:
+                pass
 
-    def __call__(self, *args, **kwargs):
-        if not hasattr(self, '_callable'):
-            imported_module = self._importer()
-            self._callable = getattr(imported_module, self._callable_name)
+            module = self._importer()
+            target = import_objects(module, self._name, None, self._file_path, self._file_path_resolved)
 
-        return self._callable(*args, **kwargs)
+            expected_type = self._expected_type
+            if expected_type is callable:
+                if not callable(target):
+                    raise TypeError(f"Import type mismatch, expected '{self._name}' to be callable but got {type(target)}")
+            elif isinstance(expected_type, type) and not isinstance(target, expected_type):
+                raise TypeError(f"Import type mismatch, expected '{self._name}' to be of type {expected_type} but got {type(target)}")
 
-class LazyModule(types.ModuleType):
-    """ Lazily-loaded module that triggers loading on attribute access """
+            self._target = target
 
-    def __init__(self, name, file_path, importer):
-        super().__init__(name)
-        self._importer = importer
-        self.__file__ = file_path
+            namespace = self._namespace
+            if namespace is not None and namespace.get(self._name) is self:
+                namespace[self._name] = target
 
-    def __getattr__(self, key):
-        if key == '_module':
-            self._module = self._importer()
-            return self._module
-        return self._module.__getattribute__(key)
+            return target
 
-###########
-# LOADERS #
-###########
+    def __getattr__(self, name):
+        # Slots that are not set yet must not trigger loading
+        if name in LazyObject.__slots__:
+            raise AttributeError(name)
+        return getattr(self._load(), name)
 
-class Loader:
-    """ Loader factory that returns either SourceFileLoader or ExtensionFileLoader depending on file_path """
-    def __new__(cls, name, file_path, *args, **kwargs):
-        _, suffix = os.path.splitext(file_path)
+    @property
+    def __class__(self):
+        return self._load().__class__
 
-        if suffix in importlib.machinery.EXTENSION_SUFFIXES:
-            return ExtensionFileLoader(name, file_path)
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
 
-        return SourceFileLoader(name, file_path, *args, **kwargs)
+    def __repr__(self):
+        return repr(self._load())
 
-class ExtensionFileLoader(importlib.machinery.ExtensionFileLoader):
-    pass
+    def __str__(self):
+        return str(self._load())
 
-class SourceFileLoader(importlib.machinery.SourceFileLoader):
-    """ Preprocessing Python source file loader """
+    def __format__(self, format_spec):
+        return format(self._load(), format_spec)
 
-    def __init__(self, name, file_path, preprocessor=None, use_cache=True, cache_path_prefix=None):
-        # Note: It seems the module name here is not really used in Python internally
-        super().__init__(name, file_path)
-        self.preprocessor = preprocessor
-        self.use_cache = use_cache
-        self.cache_path_prefix = cache_path_prefix
-        if self.preprocessor:
-            self.check_preprocess(file_path)
+    def __bool__(self):
+        return bool(self._load())
 
-    def check_preprocess(self, file_path):
-        #print('CHECK FILE', file_path)
-        file_name, file_extension = os.path.splitext(file_path)
+    def __hash__(self):
+        return hash(self._load())
 
-        # This is the file_path we pretend to be loading, so it appears in stack traces
-        self.preprocess_file_path_display = f"{file_name}__preprocessed__{file_extension}"
+    def __len__(self):
+        return len(self._load())
 
-        dir_name, file_name = os.path.split(file_name)
+    def __iter__(self):
+        return iter(self._load())
 
-        # Add cache prefix to dir_name
-        if self.cache_path_prefix:
-            if os.path.isabs(self.cache_path_prefix):
-                dir_name = f"{self.cache_path_prefix}{os.sep}{dir_name}"
-            else:
-                dir_name = f"{dir_name}{os.sep}{self.cache_path_prefix}"
+    def __contains__(self, item):
+        return item in self._load()
 
-        # This is the file_path we are really loading
-        self.preprocess_file_path = f"{dir_name}{os.sep}{file_name}__preprocessed__{file_extension}"
+    def __getitem__(self, key):
+        return self._load()[key]
 
-        # Check if preprocessed file is outdated, if yes, run the preprocessing again
-        if self.use_cache and os.path.exists(self.preprocess_file_path):
-            #print('CHECK CACHE STILL VALID?', file_path, self.preprocess_file_path)
-            preprocessed = os.stat(self.preprocess_file_path)
-            original = os.stat(file_path)
-            if original.st_mtime > preprocessed.st_mtime:
-                self.preprocess(file_path)
-        else:
-            self.preprocess(file_path)
+    def __int__(self):
+        return int(self._load())
 
-    def ensure_dir(self, path):
-        dir_name, _ = os.path.split(path)
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
+    def __float__(self):
+        return float(self._load())
 
-    def preprocess(self, file_path):
-        #print('PREP', file_path, self.use_cache, time.time())
-        self.code = self.get_data(file_path, direct=True)
-        self.code = self.preprocessor(self.code, file_path=file_path)
+    def __index__(self):
+        return operator.index(self._load())
 
-        if not self.use_cache:
-            if os.path.exists(self.preprocess_file_path):
-                os.remove(self.preprocess_file_path)
-            return
+    def __fspath__(self):
+        return os.fspath(self._load())
 
-        self.ensure_dir(self.preprocess_file_path)
+def forward_operator(function, reflected=False):
+    """ Create a method for LazyObject that applies the binary operator `function` to the loaded object """
+    if reflected:
+        return lambda self, other: function(other, self._load())
+    return lambda self, other: function(self._load(), other)
 
-        # Write processed code back for caching
-        with open(self.preprocess_file_path, 'wb') as f:
-            f.write(f"# NOTE: This file was automatically generated from:\n# {file_path}\n# DO NOT CHANGE DIRECTLY! {time.time()}\n".encode())
-            f.write(self.code.encode() if hasattr(self.code, 'encode') else self.code)
+for name, function in (('eq', operator.eq), ('ne', operator.ne), ('lt', operator.lt), ('le', operator.le), ('gt', operator.gt),
+                       ('ge', operator.ge), ('add', operator.add), ('sub', operator.sub), ('mul', operator.mul),
+                       ('truediv', operator.truediv), ('floordiv', operator.floordiv), ('mod', operator.mod),
+                       ('pow', operator.pow), ('and', operator.and_), ('or', operator.or_), ('xor', operator.xor),
+                       ('lshift', operator.lshift), ('rshift', operator.rshift), ('matmul', operator.matmul)):
+    setattr(LazyObject, f'__{name}__', forward_operator(function))
+    # Comparisons are reflected by Python itself
+    if name not in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+        setattr(LazyObject, f'__r{name}__', forward_operator(function, reflected=True))
+del name, function
 
-            #os.utime(self.preprocess_file_path, (original['mtime'], original['mtime']))
+class LazyCallable(LazyObject):
+    """ Lazily-loaded callable that triggers module loading on the first call """
 
-    def is_bytecode(self, file_path):
-        return file_path[file_path.rindex("."):] in importlib.machinery.BYTECODE_SUFFIXES
+    __slots__ = ()
 
-    def path_stats(self, path):
-        #print('STATS START', path)
-        if not self.use_cache:
-            #print('CACHE OFF')
-            # Invalidate bytecode cache
-            raise OSError
-        else:
-            if self.preprocessor:
-                #print('PRE STATS', path, self.preprocess_file_path)
-                return super().path_stats(self.preprocess_file_path)
+    def __call__(self, *args, **kwargs):
+        try:
+            target = self._target
+        except AttributeError:
+            target = self._load()
+        return target(*args, **kwargs)
 
-            #print('STATS', path)
-            return super().path_stats(path)
+class LazyClass(LazyObject):
+    """ Lazily-loaded class that triggers module loading on first use, including `isinstance()` and `issubclass()` checks """
 
-    def get_data(self, path, direct=False):
-        _, suffix = os.path.splitext(path)
-        #print('GET DATA', direct, self.preprocessor, path, suffix)
+    __slots__ = ()
 
-        # We are importing a bytecode file, so it should be direct
-        if len(suffix) > 0 and suffix in importlib.machinery.BYTECODE_SUFFIXES:
-            direct = True
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._load())
 
-        if not direct and self.preprocessor:
-            if path == self.preprocess_file_path_display:
-                path = self.preprocess_file_path
-            if not os.path.exists(path):
-                #print('GET PREP CODE', path)
-                return self.code
-        #print('GET DIRECT')
-        return super().get_data(path)
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self._load())
 
-    def get_filename(self, fullname):
-        if self.preprocessor:
-            return self.preprocess_file_path_display
-        return self.path
+    def __mro_entries__(self, bases):
+        # Allows to inherit from the lazy class
+        return (self._load(),)
 
-###########
+    @property
+    def __bases__(self):
+        # Allows `issubclass(lazy_class, base)`
+        return self._load().__bases__
+
+# Backwards compatibility
+LazyCass = LazyClass
+
+def get_lazy_class(expected_type):
+    """ Return the class of lazy objects for the `expected_type` of an object in `objects_to_import` """
+    if expected_type is callable:
+        return LazyCallable
+    if isinstance(expected_type, type) and issubclass(expected_type, type):
+        return LazyClass
+    return LazyObject
+
+class LazyModule(types.ModuleType):
+    """
+    Lazily-loaded module that is executed on first attribute access. The module is executed in place and then
+    becomes a regular module by switching its class back to `types.ModuleType`. All references to it, e.g. in
+    `sys.modules` or in the namespace of the caller, stay valid and attribute access does not go through this class
+    anymore.
+    """
+
+    def __init__(self, name, file_path, loader):
+        super().__init__(name)
+        self.__file__ = file_path
+        # Module -> state, as long as it has not been executed
+        lazy_modules[self] = { 'loader': loader, 'lock': threading.RLock(), 'loading': False }
+
+    def __getattribute__(self, key):
+        state = lazy_modules.get(self)
+        if state is not None:
+            with state['lock']:
+                # The thread executing the module sees it as it is, other threads wait until it is complete
+                if not state['loading'] and lazy_modules.get(self) is state:
+                    state['loading'] = True
+                    try:
+                        state['loader'](self)
+                    finally:
+                        state['loading'] = False
+                    self.__class__ = types.ModuleType
+                    del lazy_modules[self]
+        return types.ModuleType.__getattribute__(self, key)
+
+##############
+# STAT CACHE #
+##############
+
+class StatCache:
+    """
+    Answers file system checks from directory listings. Every directory is listed once with `os.scandir()`, instead
+    of one system call for every check of every file. A listing is renewed when the modification time of the
+    directory changes, if `check_mtime` is set, or when it is invalidated explicitly.
+    """
+
+    def __init__(self, check_mtime=True):
+        self.check_mtime = check_mtime
+        # Directory path -> (modification time, dict of names and os.DirEntry objects or None if it does not exist)
+        self.directories = {}
+        # Number of checks answered and system calls really made
+        self.checks = 0
+        self.syscalls = 0
+
+    def get_mtime(self, dir_name):
+        self.syscalls += 1
+        import_stats.counters['stat_calls'] += 1
+        try:
+            return os.stat(dir_name).st_mtime_ns
+        except OSError:
+            return None
+
+    def get_entry(self, file_path):
+        """ Return the os.DirEntry for `file_path` or `None` if it does not exist """
+        self.checks += 1
+        dir_name, name = os.path.split(file_path)
+
+        # E.g. the root directory has no entry in a parent directory
+        if not name:
+            return None
+
+        listing = self.directories.get(dir_name)
+        mtime = None
+        if listing is None or self.check_mtime:
+            mtime = self.get_mtime(dir_name)
+            if listing is not None and listing[0] != mtime:
+                listing = None
+
+        if listing is None:
+            entries = None
+            if mtime is not None:
+                self.syscalls += 1
+                import_stats.counters['stat_calls'] += 1
+                try:
+                    with os.scandir(dir_name) as it:
+                        entries = { entry.name: entry for entry in it }
+                except OSError:
+                    pass
+            listing = self.directories[dir_name] = (mtime, entries)
+
+        return listing[1].get(name) if listing[1] else None
+
+    def exists(self, file_path):
+        if self.get_entry(file_path):
+            return True
+        # Directories without an entry in a parent, e.g. the root directory
+        return not os.path.basename(file_path) and os.path.exists(file_path)
+
+    def isfile(self, file_path):
+        entry = self.get_entry(file_path)
+        return bool(entry) and entry.is_file()
+
+    def status(self, file_path):
+        """ Answer exists, isfile and readable with a single lookup """
+        entry = self.get_entry(file_path)
+        # Three checks answered
+        self.checks += 2
+        if not entry:
+            return self.exists(file_path), False, False
+        return True, entry.is_file(), self.is_entry_readable(entry)
+
+    def isdir(self, file_path):
+        entry = self.get_entry(file_path)
+        if not entry:
+            return not os.path.basename(file_path) and os.path.isdir(file_path)
+        return entry.is_dir()
+
+    def readable(self, file_path):
+        entry = self.get_entry(file_path)
+        return bool(entry) and self.is_entry_readable(entry)
+
+    def is_entry_readable(self, entry):
+        """ Derive read access from the permission bits, the stat result is cached by the os.DirEntry """
+        if os.name == 'nt':
+            return True
+
+        import stat
+        st = entry.stat()
+        uid = os.geteuid()
+        if uid == 0:
+            return True
+        if st.st_uid == uid:
+            return bool(st.st_mode & stat.S_IRUSR)
+        if st.st_gid == os.getegid() or st.st_gid in os.getgroups():
+            return bool(st.st_mode & stat.S_IRGRP)
+        return bool(st.st_mode & stat.S_IROTH)
+
+    def invalidate(self, dir_name=None):
+        """ Forget the listing of a directory or of all directories """
+        if dir_name is None:
+            self.directories.clear()
+        else:
+            self.directories.pop(os.path.abspath(dir_name), None)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of `checks` answered, `syscalls` made and `syscalls_saved` compared to one system call
+                per check, as well as the number of cached `directories`
+        """
+        return {
+            'checks': self.checks,
+            'syscalls': self.syscalls,
+            'syscalls_saved': self.checks - self.syscalls,
+            'directories': len(self.directories),
+        }
+
+##############
+# STATISTICS #
+##############
+
+class ImportStats:
+    """
+    Collects the time spent in the phases of importing each file as well as counters of cache hits and misses
+    and file system checks.
+
+    The phases are `resolve` (finding the caller and the file), `check` (checking the file is importable),
+    `preprocess`, `compile` (compiling or loading a cached code object) and `exec` (executing the module,
+    including nested imports).
+    """
+
+    phases = ('resolve', 'check', 'preprocess', 'compile', 'exec')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # File path -> dict of phase -> seconds
+        self.files = collections.defaultdict(lambda: dict.fromkeys(self.phases + ('cumulative', 'nested'), 0.0))
+        self.counters = collections.Counter()
+        # Per thread stack of the time spent in nested imports
+        self.local = threading.local()
+
+    def add(self, file_path, phase, started, excluded=0.0):
+        """
+        Add the time from `started` until now, less the `excluded` seconds, to a phase of importing `file_path`.
+
+        Returns:
+            float: The seconds since `started`
+        """
+        ended = time.perf_counter()
+        self.files[file_path][phase] += ended - started - excluded
+        if tracer:
+            tracer.add(phase, started, ended, file_path=file_path)
+        return ended - started
+
+    @contextlib.contextmanager
+    def measure(self, file_path, started, caller_reference=None):
+        """ Measure the cumulative time of an import and separate it from the time spent in nested imports """
+        try:
+            stack = self.local.stack
+        except AttributeError:
+            stack = self.local.stack = []
+
+        stack.append(0.0)
+        try:
+            yield
+        finally:
+            nested = stack.pop()
+            ended = time.perf_counter()
+            timings = self.files[file_path]
+            timings['cumulative'] += ended - started
+            timings['nested'] += nested
+            if stack:
+                stack[-1] += ended - started
+            if tracer:
+                # Lazy objects pass the location where they were created as `caller_reference`
+                tracer.add(os.path.basename(file_path), started, ended, category='import', file_path=file_path,
+                           caller_reference=caller_reference, lazy=caller_reference is not None)
+
+    def report(self):
+        files = {}
+        for file_path, timings in list(self.files.items()):
+            timings = dict(timings)
+            nested = timings.pop('nested')
+            # Imports of other files are part of `exec`
+            timings['self'] = timings['cumulative'] - nested
+            files[file_path] = timings
+
+        counters = dict.fromkeys(('cache_hits', 'cache_misses', 'cache_evictions', 'unloads', 'preprocessor_cache_hits',
+                                  'preprocessor_cache_misses', 'stat_calls'), 0)
+        counters.update(self.counters)
+
+        return { 'files': files, 'counters': counters }
+
+    def format(self, limit=None):
+        """ Format a summary sorted by cumulative time, similar to `python -X importtime` """
+        report = self.report()
+        columns = ('self', 'cumulative') + self.phases
+        lines = [ 'ultraimport: ' + ' | '.join(f'{column} [us]' for column in columns) + ' | file' ]
+
+        files = sorted(report['files'].items(), key=lambda item: item[1]['cumulative'], reverse=True)
+        for file_path, timings in files[:limit]:
+            values = ' | '.join(f"{int(timings[column] * 1e6):>{len(column) + 5}}" for column in columns)
+            lines.append(f'ultraimport: {values} | {file_path}')
+
+        lines.append('ultraimport: ' + ', '.join(f'{name}={value}' for name, value in report['counters'].items()))
+        return '\n'.join(lines)
+
+import_stats = ImportStats()
+
+def stats(reset=False):
+    """
+    Return statistics about where ultraimport spends its time.
+
+    Set the environment variable `ULTRAIMPORT_STATS=1` to print a summary when the program exits.
+
+    Parameters:
+        reset (bool): If `True`, start collecting from scratch after returning the current statistics.
+
+    Returns:
+        dict: `files` maps every resolved file path to the seconds spent in each phase of importing it: `resolve`,
+            `check`, `preprocess`, `compile`, `exec`, `cumulative` (including nested imports) and `self` (excluding
+            nested imports). `counters` contains `cache_hits`, `cache_misses`, `preprocessor_cache_hits`,
+            `preprocessor_cache_misses` and `stat_calls`.
+    """
+    report = import_stats.report()
+    if reset:
+        import_stats.reset()
+    return report
+
+def print_stats(file=None):
+    """ Print a summary of stats(), by default to stderr """
+    print(import_stats.format(), file=file or sys.stderr)
+
+if os.environ.get('ULTRAIMPORT_STATS', '').lower() in {'1', 'true', 'yes', 'on'}:
+    import atexit
+    atexit.register(print_stats)
+
+class Tracer:
+    """ Records every import and its phases as events that can be written as Chrome trace or speedscope file """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # Tuples of name, category, start, end, thread id and arguments
+        self.events = []
+
+    def add(self, name, started, ended, category='phase', **args):
+        # list.append() is atomic, so threads can record events concurrently
+        self.events.append((name, category, started, ended, threading.get_ident(), args))
+
+    def to_chrome_trace(self):
+        """ Return the events in the Chrome trace event format, see chrome://tracing or https://ui.perfetto.dev """
+        pid = os.getpid()
+        trace_events = [ {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (started - self.started) * 1e6,
+            'dur': (ended - started) * 1e6,
+            'pid': pid,
+            'tid': tid,
+            'args': args,
+        } for name, category, started, ended, tid, args in self.events ]
+        return { 'traceEvents': trace_events, 'displayTimeUnit': 'ms' }
+
+    def to_speedscope(self):
+        """ Return the events in the speedscope file format, see https://www.speedscope.app """
+        frames = []
+        frame_ids = {}
+        threads = collections.defaultdict(list)
+        for name, category, started, ended, tid, args in self.events:
+            frame = (name, args.get('file_path'))
+            if frame not in frame_ids:
+                frame_ids[frame] = len(frames)
+                frames.append({ 'name': name, 'file': frame[1] })
+            # Sort order: time, closing before opening, inner events close first and outer events open first
+            threads[tid].append(((started - self.started) * 1e6, 1, started - ended, 'O', frame_ids[frame]))
+            threads[tid].append(((ended - self.started) * 1e6, 0, ended - started, 'C', frame_ids[frame]))
+
+        profiles = []
+        for tid, events in threads.items():
+            events.sort()
+            profiles.append({
+                'type': 'evented',
+                'name': f'Thread {tid}',
+                'unit': 'microseconds',
+                'startValue': events[0][0],
+                'endValue': events[-1][0],
+                'events': [ { 'type': event_type, 'at': at, 'frame': frame } for at, _, _, event_type, frame in events ],
+            })
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': { 'frames': frames },
+            'profiles': profiles,
+            'name': 'ultraimport',
+            'exporter': 'ultraimport',
+        }
+
+    def save(self, file_path, format=None):
+        """
+        Parameters:
+            file_path (str): File to write the trace to
+            format (str): `'chrome'` or `'speedscope'`. By default, files ending with `.speedscope.json` are written
+                in speedscope format and all others in Chrome trace format.
+        """
+        import json
+        if format is None:
+            format = 'speedscope' if file_path.endswith('.speedscope.json') else 'chrome'
+        if format not in ('chrome', 'speedscope'):
+            raise ValueError(f"Unknown trace format '{format}', use 'chrome' or 'speedscope'")
+
+        data = self.to_speedscope() if format == 'speedscope' else self.to_chrome_trace()
+        with open(file_path, 'w') as f:
+            json.dump(data, f)
+
+# The active Tracer, see start_trace()
+tracer = None
+
+def start_trace():
+    """
+    Start recording begin and end of every import and its phases, including the thread and whether it was a lazy load.
+
+    Set the environment variable `ULTRAIMPORT_TRACE` to a file path to trace the whole program and write the trace
+    when the program exits.
+
+    Returns:
+        Tracer: The new tracer
+    """
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+def stop_trace(file_path=None, format=None):
+    """
+    Stop recording and optionally write the trace to a file.
+
+    Parameters:
+        file_path (str): If set, write the trace to this file, see `Tracer.save()`
+        format (str): `'chrome'` or `'speedscope'`, derived from `file_path` by default
+
+    Returns:
+        Tracer: The stopped tracer or `None` if no trace was running
+    """
+    global tracer
+    stopped, tracer = tracer, None
+    if stopped and file_path:
+        stopped.save(file_path, format=format)
+    return stopped
+
+if os.environ.get('ULTRAIMPORT_TRACE'):
+    import atexit
+    start_trace()
+    atexit.register(stop_trace, os.environ['ULTRAIMPORT_TRACE'])
+
+###########
+# LOCKING #
+###########
+
+class ImportLock:
+    """
+    Re-entrant lock for a single resolved file path. Similar to the module locks of importlib, it detects
+    deadlocks between threads whose imports depend on each other.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.owner = None
+        self.count = 0
+        # Number of threads holding or waiting for the lock, managed by import_lock()
+        self.users = 0
+
+    def has_deadlock(self):
+        """ Follow the chain of lock owners waiting for other locks and check if it leads back to us """
+        tid = threading.get_ident()
+        seen = set()
+        lock = self
+        while lock:
+            owner = lock.owner
+            if owner is None or owner in seen:
+                return False
+            if owner == tid:
+                return True
+            seen.add(owner)
+            lock = import_lock_waiters.get(owner)
+        return False
+
+    def acquire(self):
+        """ Acquire the lock, blocking until it is free. Returns `False` instead of blocking in case of a deadlock. """
+        tid = threading.get_ident()
+        # Register as waiting before checking, so out of two threads racing into a deadlock at least one sees it
+        import_lock_waiters[tid] = self
+        try:
+            with self.condition:
+                while True:
+                    if self.count == 0 or self.owner == tid:
+                        self.owner = tid
+                        self.count += 1
+                        return True
+                    if self.has_deadlock():
+                        return False
+                    self.condition.wait()
+        finally:
+            del import_lock_waiters[tid]
+
+    def release(self):
+        with self.condition:
+            self.count -= 1
+            if self.count == 0:
+                self.owner = None
+                self.condition.notify()
+
+##################
+# CACHE BACKENDS #
+##################
+
+class CacheBackend:
+    """
+    Interface for storing preprocessed source code and code objects. Entries have a name and are validated
+    by a key. Backends must be thread-safe. Caching is best effort, so backends should ignore write errors,
+    e.g. on read-only file systems.
+    """
+
+    def get(self, name, key):
+        """ Return the data of entry `name` as bytes if it was stored with the same `key`, otherwise `None` """
+        raise NotImplementedError
+
+    def set(self, name, key, data):
+        """ Store the bytes `data` as entry `name` with the validation key `key` """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """ Remove entry `name` if it exists """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Remove all entries """
+        raise NotImplementedError
+
+class MemoryCache(CacheBackend):
+    """ Keeps all entries in memory of the current process """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, name, key):
+        entry = self.entries.get(name)
+        if entry and entry[0] == key:
+            return entry[1]
+        return None
+
+    def set(self, name, key, data):
+        self.entries[name] = (key, data.encode() if hasattr(data, 'encode') else data)
+
+    def delete(self, name):
+        self.entries.pop(name, None)
+
+    def clear(self):
+        self.entries.clear()
+
+class DirectoryCache(CacheBackend):
+    """
+    Stores every entry in its own file in a single directory, independent of where the source files are.
+    The directory may be shared with other files, so only files with `suffix` belong to the cache.
+    """
+
+    suffix = '.ultraimport-cache'
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def get_file_path(self, name):
+        import hashlib
+        return f"{self.path}{os.sep}{hashlib.sha256(name.encode()).hexdigest()[:32]}{self.suffix}"
+
+    def get(self, name, key):
+        try:
+            with open(self.get_file_path(name), 'rb') as f:
+                stored_key = f.readline().rstrip(b'\n')
+                if stored_key != key.encode():
+                    return None
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, name, key, data):
+        with contextlib.suppress(OSError):
+            write_file_atomic(self.get_file_path(name), key.encode() + b'\n' + (data.encode() if hasattr(data, 'encode') else data))
+
+    def delete(self, name):
+        with contextlib.suppress(OSError):
+            os.remove(self.get_file_path(name))
+
+    def clear(self):
+        try:
+            entries = list(os.scandir(self.path))
+        except OSError:
+            return
+        for entry in entries:
+            # Also remove temporary files of writes that have been interrupted
+            if entry.name.endswith(self.suffix) or (self.suffix + '.' in entry.name and entry.name.endswith('.tmp')):
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+
+class SQLiteCache(CacheBackend):
+    """
+    Stores all entries in a single SQLite database file. A lookup is one indexed query instead of several file
+    system operations and the single file is easy to ship, e.g. in a container image. A database that cannot be
+    written, e.g. in a read-only image, is only read, `read_only=True` skips trying to write it at all. If there is
+    no database and it cannot be created either, the cache is turned off.
+    """
+
+    def __init__(self, path, read_only=False):
+        import sqlite3
+        self.sqlite3 = sqlite3
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.read_only = read_only
+        self.connection = None
+        if not read_only:
+            try:
+                self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                # No WAL mode: it is stored in the database file and a database in WAL mode cannot be read in a
+                # read-only directory. This also switches back databases written by earlier versions.
+                self.connection.execute('PRAGMA journal_mode=DELETE')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS cache (name TEXT PRIMARY KEY, key TEXT NOT NULL, data BLOB NOT NULL)')
+            except sqlite3.OperationalError:
+                # E.g. a read-only file system
+                if self.connection:
+                    self.connection.close()
+                self.read_only = True
+        if self.read_only:
+            self.connection = self.connect_read_only()
+
+    def connect_read_only(self):
+        """ Open the database without ever writing to it, returns `None` if there is no database """
+        if not os.path.isfile(self.path):
+            return None
+        import pathlib
+        # `immutable` also skips locking, which would need to write files next to the database
+        return self.sqlite3.connect(f"{pathlib.Path(self.path).as_uri()}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+
+    def is_writable(self):
+        return all(os.access(path, os.W_OK) for path in (self.path, os.path.dirname(self.path)))
+
+    def read(self, *args):
+        with self.lock:
+            if self.connection is None:
+                return None
+            try:
+                return self.connection.execute(*args).fetchone()
+            except self.sqlite3.OperationalError:
+                # Reading can need write access, e.g. to the directory for locking. Everything else is a real error.
+                if self.read_only or self.is_writable():
+                    raise
+            self.connection.close()
+            self.read_only = True
+            self.connection = self.connect_read_only()
+            return self.connection.execute(*args).fetchone() if self.connection else None
+
+    def write(self, *args):
+        with self.lock:
+            if self.connection is None or self.read_only:
+                return
+            # Caching is best effort, e.g. the database may be read-only
+            with contextlib.suppress(self.sqlite3.OperationalError):
+                self.connection.execute(*args)
+
+    def get(self, name, key):
+        row = self.read('SELECT data FROM cache WHERE name = ? AND key = ?', (name, key))
+        return row[0] if row else None
+
+    def set(self, name, key, data):
+        self.write('INSERT OR REPLACE INTO cache (name, key, data) VALUES (?, ?, ?)',
+                   (name, key, data.encode() if hasattr(data, 'encode') else data))
+
+    def delete(self, name):
+        self.write('DELETE FROM cache WHERE name = ?', (name,))
+
+    def clear(self):
+        self.write('DELETE FROM cache')
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+
+###########
+# LOADERS #
+###########
+
+class Loader:
+    """ Loader factory that returns either SourceFileLoader or ExtensionFileLoader depending on file_path """
+    def __new__(cls, name, file_path, *args, **kwargs):
+        _, suffix = os.path.splitext(file_path)
+
+        if suffix in importlib.machinery.EXTENSION_SUFFIXES:
+            return ExtensionFileLoader(name, file_path)
+
+        return SourceFileLoader(name, file_path, *args, **kwargs)
+
+class ExtensionFileLoader(importlib.machinery.ExtensionFileLoader):
+    pass
+
+class SourceFileLoader(importlib.machinery.SourceFileLoader):
+    """ Preprocessing Python source file loader """
+
+    def __init__(self, name, file_path, preprocessor=None, use_cache=True, cache_path_prefix=None, use_code_cache=False,
+                 cache_backend=None, code_object=None):
+        # Note: It seems the module name here is not really used in Python internally
+        super().__init__(name, file_path)
+        self.preprocessor = preprocessor
+        self.use_cache = use_cache
+        self.cache_path_prefix = cache_path_prefix
+        self.use_code_cache = use_code_cache
+        self.cache_backend = cache_backend
+        self.code = None
+        # Source hash and preprocessor fingerprint, set by check_preprocess()
+        self.cache_key = None
+        # Time spent in get_code() and preprocess(), for import_stats
+        self.get_code_time = 0
+        self.preprocess_time = 0
+        # A given code object, e.g. from a snapshot, is already preprocessed and compiled
+        self.code_object = code_object
+        # Only in the default mode, the preprocessed code is loaded from a preprocessed file next to the source file
+        self.use_preprocessed_file = not (use_code_cache or cache_backend or code_object is not None)
+        if self.preprocessor:
+            self.set_preprocess_file_paths(file_path)
+            if code_object is None:
+                self.check_preprocess(file_path)
+
+    def prefetch(self):
+        """ Read and compile the module code ahead of time, so exec_module() can use it from memory """
+        self.code_object = self.get_code(self.name)
+
+    def get_code(self, fullname):
+        code_object = self.code_object
+        if code_object is not None:
+            # Prefetched code is only used once, a module executed again must pick up changes
+            self.code_object = None
+            return code_object
+
+        started = time.perf_counter()
+        preprocess_time = self.preprocess_time
+        code_object = super().get_code(fullname)
+        self.get_code_time += import_stats.add(self.path, 'compile', started, excluded=self.preprocess_time - preprocess_time)
+        return code_object
+
+    def set_preprocess_file_paths(self, file_path):
+        file_name, file_extension = os.path.splitext(file_path)
+
+        # This is the file_path we pretend to be loading, so it appears in stack traces
+        self.preprocess_file_path_display = f"{file_name}__preprocessed__{file_extension}"
+
+        dir_name, file_name = os.path.split(file_name)
+
+        # Add cache prefix to dir_name
+        if self.cache_path_prefix:
+            if os.path.isabs(self.cache_path_prefix):
+                dir_name = f"{self.cache_path_prefix}{os.sep}{dir_name}"
+            else:
+                dir_name = f"{dir_name}{os.sep}{self.cache_path_prefix}"
+
+        # This is the file_path we are really loading
+        self.preprocess_file_path = f"{dir_name}{os.sep}{file_name}__preprocessed__{file_extension}"
+
+        # Marshalled code object of the preprocessed module, if `use_code_cache` is set
+        self.code_cache_path = f"{self.preprocess_file_path}.marshal"
+
+    def check_preprocess(self, file_path):
+        #print('CHECK FILE', file_path)
+
+        # The preprocessed file is only valid if it was generated from the same source code by the same preprocessor.
+        # Modification times are not reliable for this, e.g. container image layers normalize them.
+        started = time.perf_counter()
+        compile_time = 0
+        source = self.get_data(file_path, direct=True)
+        self.cache_key = f"{get_source_hash(source)}-{get_preprocessor_fingerprint(self.preprocessor)}"
+
+        if self.use_code_cache:
+            compile_started = time.perf_counter()
+            if self.use_cache:
+                self.code_object = self.read_code_cache(file_path)
+            if self.code_object is None:
+                self.preprocess(file_path, source)
+                self.code_object = self.source_to_code(self.code, self.preprocess_file_path_display)
+                if self.use_cache:
+                    self.write_code_cache(file_path)
+            compile_time = import_stats.add(self.path, 'compile', compile_started, excluded=self.preprocess_time) - self.preprocess_time
+        elif self.cache_backend:
+            if self.use_cache:
+                self.code = self.cache_backend.get(f"source:{file_path}", self.cache_key)
+            if self.code is None:
+                self.preprocess(file_path, source)
+        elif not self.use_cache or self.read_cache_key(file_path) != self.cache_key:
+            self.preprocess(file_path, source)
+
+        import_stats.counters['preprocessor_cache_misses' if self.preprocess_time else 'preprocessor_cache_hits'] += 1
+        # Checking the cache is part of preprocessing
+        import_stats.add(self.path, 'preprocess', started, excluded=compile_time + self.preprocess_time)
+
+    def get_code_cache_header(self, file_path):
+        return importlib.util.MAGIC_NUMBER + f"{file_path}\n{self.cache_key}\n".encode()
+
+    def read_code_cache(self, file_path):
+        """ Return the cached code object or `None` if there is no valid one """
+        header = self.get_code_cache_header(file_path)
+
+        if self.cache_backend:
+            data = self.cache_backend.get(f"code:{file_path}", self.cache_key)
+        else:
+            try:
+                with open(self.code_cache_path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+
+        if not data or not data.startswith(header):
+            return None
+
+        try:
+            return marshal.loads(memoryview(data)[len(header):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def write_code_cache(self, file_path):
+        data = self.get_code_cache_header(file_path) + marshal.dumps(self.code_object)
+        if self.cache_backend:
+            self.cache_backend.set(f"code:{file_path}", self.cache_key, data)
+        else:
+            write_file_atomic(self.code_cache_path, data)
+
+    def read_cache_key(self, file_path):
+        """ Return the cache key from the header of the preprocessed file or `None` """
+        try:
+            with open(self.preprocess_file_path, 'rb') as f:
+                header = [ f.readline() for _ in range(3) ]
+        except OSError:
+            return None
+
+        # The preprocessed file must belong to the same source file
+        if header[1].decode(errors='replace').rstrip('\r\n') != f"# {file_path}":
+            return None
+
+        _, found, cache_key = header[2].decode(errors='replace').partition('Cache key: ')
+        return cache_key.strip() if found else None
+
+    def preprocess(self, file_path, source=None):
+        #print('PREP', file_path, self.use_cache, time.time())
+        started = time.perf_counter()
+        try:
+            self._preprocess(file_path, source)
+        finally:
+            self.preprocess_time += import_stats.add(self.path, 'preprocess', started)
+
+    def _preprocess(self, file_path, source=None):
+        if source is None:
+            source = self.get_data(file_path, direct=True)
+        if self.cache_key is None:
+            # Code objects from a snapshot skip check_preprocess(), but the source may be needed e.g. for tracebacks
+            self.cache_key = f"{get_source_hash(source)}-{get_preprocessor_fingerprint(self.preprocessor)}"
+        self.code = run_preprocessor(self.preprocessor, source, file_path=file_path)
+
+        if self.use_code_cache:
+            # The code object is cached instead
+            return
+
+        if self.cache_backend:
+            if self.use_cache:
+                self.cache_backend.set(f"source:{file_path}", self.cache_key, self.code)
+            return
+
+        if not self.use_cache:
+            if os.path.exists(self.preprocess_file_path):
+                os.remove(self.preprocess_file_path)
+            return
+
+        # Write processed code back for caching
+        header = f"# NOTE: This file was automatically generated from:\n# {file_path}\n# DO NOT CHANGE DIRECTLY! Cache key: {self.cache_key}\n"
+        write_file_atomic(self.preprocess_file_path, header.encode() + (self.code.encode() if hasattr(self.code, 'encode') else self.code))
+
+    def is_bytecode(self, file_path):
+        return file_path[file_path.rindex("."):] in importlib.machinery.BYTECODE_SUFFIXES
+
+    def path_stats(self, path):
+        #print('STATS START', path)
+        if not self.use_cache or (self.preprocessor and not self.use_preprocessed_file):
+            #print('CACHE OFF')
+            # Invalidate bytecode cache, also there is no preprocessed file to create bytecode for
+            raise OSError
+        else:
+            if self.preprocessor:
+                #print('PRE STATS', path, self.preprocess_file_path)
+                return super().path_stats(self.preprocess_file_path)
+
+            #print('STATS', path)
+            return super().path_stats(path)
+
+    def get_data(self, path, direct=False):
+        _, suffix = os.path.splitext(path)
+        #print('GET DATA', direct, self.preprocessor, path, suffix)
+
+        # We are importing a bytecode file, so it should be direct
+        if len(suffix) > 0 and suffix in importlib.machinery.BYTECODE_SUFFIXES:
+            direct = True
+
+        if not direct and self.preprocessor:
+            if path == self.preprocess_file_path_display:
+                path = self.preprocess_file_path
+            # Any preprocessed file we find in other cache modes might be outdated
+            if not self.use_preprocessed_file or not path_exists(path):
+                #print('GET PREP CODE', path)
+                if self.code is None:
+                    # Code objects from the code cache come without source code, e.g. for tracebacks we need it
+                    self.preprocess(self.path)
+                return self.code
+        #print('GET DIRECT')
+        return super().get_data(path)
+
+    def get_filename(self, fullname):
+        if self.preprocessor:
+            return self.preprocess_file_path_display
+        return self.path
+
+##########
+# FINDER #
+##########
+
+class PathFinder:
+    """
+    Meta path finder that serves the modules of mapped packages with ultraimport's loaders. Plain `import`
+    statements, including relative imports, work inside of these packages without rewriting the source code.
+    Install it with install_finder().
+    """
+
+    # Checked in the same order as by Python's own FileFinder
+    suffixes = importlib.machinery.EXTENSION_SUFFIXES + importlib.machinery.SOURCE_SUFFIXES
+
+    def __init__(self, path_map, preprocessor=None, use_preprocessor_cache=True, cache_path_prefix=None,
+                 use_code_cache=False, cache_backend=None):
+        # Module name -> directory of the package or file path of the module
+        self.path_map = { name: os.path.abspath(path) for name, path in path_map.items() }
+        # Longest names first, so nested mappings win over their parents
+        self.names = sorted(self.path_map, key=len, reverse=True)
+        self.preprocessor = preprocessor
+        self.use_preprocessor_cache = use_preprocessor_cache
+        self.cache_path_prefix = cache_path_prefix
+        self.use_code_cache = use_code_cache
+        self.cache_backend = cache_backend
+        # Module name -> (file path or None, directory if it is a package or None). Missing modules are not
+        # remembered, because Python's own finders would pick them up from the `__path__` of the package otherwise.
+        self.locations = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path_map!r})'
+
+    def find_location(self, fullname):
+        """
+        Returns:
+            tuple: File path of the module or `None` for namespace packages and the package directory or `None`
+            for plain modules. Returns `None` if `fullname` is not served by this finder.
+        """
+        for name in self.names:
+            if fullname == name:
+                path = self.path_map[name]
+                if is_dir(path):
+                    return self.find_package(path, [ path ])
+                if is_file(path):
+                    return path, None
+                return None
+            if fullname.startswith(name + '.'):
+                base = os.path.join(self.path_map[name], *fullname[len(name) + 1:].split('.'))
+                package = self.find_package(base, [ base ]) if is_dir(base) else None
+                if package and package[0]:
+                    return package
+                for suffix in self.suffixes:
+                    if is_file(base + suffix):
+                        return base + suffix, None
+                # A directory without `__init__` file is a namespace package, but a module file takes precedence
+                return package
+
+        # Parents of mapped names, e.g. `org` for `org.app`, become namespace packages
+        for name in self.names:
+            if name.startswith(fullname + '.'):
+                return None, []
+        return None
+
+    def find_package(self, path, locations):
+        for suffix in self.suffixes:
+            init_file = os.path.join(path, '__init__' + suffix)
+            if is_file(init_file):
+                return init_file, locations
+        return None, locations
+
+    def find_spec(self, fullname, path=None, target=None):
+        location = self.locations.get(fullname)
+        if location is None:
+            location = self.find_location(fullname)
+            if location is None:
+                return None
+            self.locations[fullname] = location
+
+        file_path, locations = location
+        if file_path is None:
+            spec = importlib.machinery.ModuleSpec(fullname, None, is_package=True)
+            spec.submodule_search_locations = list(locations)
+            return spec
+
+        loader = Loader(fullname, file_path, preprocessor=self.preprocessor, use_cache=self.use_preprocessor_cache,
+                        cache_path_prefix=self.cache_path_prefix, use_code_cache=self.use_code_cache,
+                        cache_backend=self.cache_backend)
+        return importlib.util.spec_from_file_location(fullname, file_path, loader=loader,
+                                                      submodule_search_locations=None if locations is None else list(locations))
+
+    def invalidate_caches(self):
+        """ Forget all module locations, called by `importlib.invalidate_caches()` """
+        self.locations.clear()
+
+def install_finder(path_map, preprocessor=None, use_preprocessor_cache=True, cache_path_prefix=None, use_code_cache=False,
+                   cache_backend=None):
+    """
+    Install a meta path finder, so plain `import` statements find the modules of the packages in `path_map` and load
+    them with ultraimport. Other modules are still found by Python as usual.
+
+    Parameters:
+        path_map (dict): Maps package names, like `'myapp'` or `'org.app'`, to the directory of the package. A name
+            can also be mapped to the file path of a single module. Submodules and subpackages are found relative
+            to the directory.
+
+        preprocessor, use_preprocessor_cache, cache_path_prefix, use_code_cache, cache_backend: Same as for
+            ultraimport().
+
+    Returns:
+        PathFinder: The installed finder, it can be removed with uninstall_finder().
+    """
+    finder = PathFinder(path_map, preprocessor=preprocessor, use_preprocessor_cache=use_preprocessor_cache,
+                        cache_path_prefix=cache_path_prefix, use_code_cache=use_code_cache, cache_backend=cache_backend)
+    # Mapped packages take precedence over modules of the same name on `sys.path`
+    sys.meta_path.insert(0, finder)
+    return finder
+
+def uninstall_finder(finder=None):
+    """ Remove the given `finder` or all finders installed by install_finder() from `sys.meta_path` """
+    sys.meta_path[:] = [ item for item in sys.meta_path
+                         if not (item is finder or (finder is None and isinstance(item, PathFinder))) ]
+
+#################
+# PREPROCESSING #
+#################
+
+class RecursePreprocessor:
+    """ Preprocessor for `recurse=True`, runs the user's preprocessor first and then rewrites relative imports """
+
+    def __init__(self, preprocessor=None):
+        self.preprocessor = preprocessor
+
+    def __call__(self, source, *args, **kwargs):
+        if self.preprocessor:
+            source = self.preprocessor(source, *args, **kwargs)
+        return RewriteImport.transform_imports(source, *args, **kwargs)
+
+    def __eq__(self, other):
+        return type(other) is RecursePreprocessor and other.preprocessor == self.preprocessor
+
+    def __hash__(self):
+        return hash((RecursePreprocessor, self.preprocessor))
+
+    @property
+    def cache_key(self):
+        # Changes of the import rewriting or of the user's preprocessor invalidate cached files
+        rewrite = get_preprocessor_fingerprint(RewriteImport)
+        if not self.preprocessor:
+            return f"recurse:{rewrite}"
+        return f"recurse:{rewrite}:{get_preprocessor_fingerprint(self.preprocessor)}"
+
+# Cache for get_preprocessor_fingerprint(), the keys are the preprocessors
+preprocessor_fingerprints = {}
+
+def get_source_hash(source):
+    """ Return a hash of the source code for cache keys """
+    import hashlib
+    return hashlib.sha256(source.encode() if hasattr(source, 'encode') else source).hexdigest()
+
+def get_preprocessor_fingerprint(preprocessor):
+    """
+    Identify a preprocessor and its version, so cached results of another preprocessor or an older version of it
+    are not reused.
+
+    A preprocessor can declare a `cache_key` or a `version` attribute. Otherwise, the fingerprint is derived
+    from a hash of its code.
+
+    Parameters:
+        preprocessor (callable): Any preprocessor function or callable object
+
+    Returns:
+        str: The fingerprint
+    """
+    cache_key = getattr(preprocessor, 'cache_key', None)
+    if cache_key is not None:
+        return str(cache_key)
+
+    name = getattr(preprocessor, '__qualname__', type(preprocessor).__qualname__)
+
+    version = getattr(preprocessor, 'version', None)
+    if version is not None:
+        return f"{name}:{version}"
+
+    # Hashing the code is comparably expensive, so we remember the result
+    try:
+        return preprocessor_fingerprints[preprocessor]
+    except (KeyError, TypeError):
+        pass
+
+    import hashlib
+    h = hashlib.sha256(name.encode())
+    update_code_hash(h, preprocessor)
+    fingerprint = h.hexdigest()[:16]
+
+    try:
+        preprocessor_fingerprints[preprocessor] = fingerprint
+    except TypeError:
+        # Unhashable preprocessor
+        pass
+
+    return fingerprint
+
+def update_code_hash(h, obj):
+    """ Update hash `h` with the code of a function, method, class or callable object """
+    if isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        h.update(repr(obj.co_names).encode())
+        for const in obj.co_consts:
+            update_code_hash(h, const)
+    elif isinstance(obj, (types.FunctionType, types.MethodType)):
+        update_code_hash(h, getattr(obj, '__func__', obj).__code__)
+    elif isinstance(obj, (classmethod, staticmethod)):
+        update_code_hash(h, obj.__func__)
+    elif isinstance(obj, type):
+        for name, value in sorted(vars(obj).items()):
+            if isinstance(value, (types.FunctionType, classmethod, staticmethod)):
+                h.update(name.encode())
+                update_code_hash(h, value)
+    elif isinstance(obj, frozenset):
+        # The order of sets depends on hash randomization
+        h.update(repr(sorted(map(repr, obj))).encode())
+    elif callable(obj) and not isinstance(obj, types.BuiltinFunctionType):
+        update_code_hash(h, type(obj))
+        # E.g. functools.partial
+        for attribute in ('func', 'args', 'keywords'):
+            if hasattr(obj, attribute):
+                update_code_hash(h, getattr(obj, attribute))
+    else:
+        h.update(repr(obj).encode())
+
+# Cache for is_picklable(), the keys are the preprocessors
+picklable_preprocessors = {}
+
+def is_picklable(preprocessor):
+    """ Check if a preprocessor can be sent to a worker process """
+    try:
+        return picklable_preprocessors[preprocessor]
+    except (KeyError, TypeError):
+        pass
+
+    import pickle
+    try:
+        pickle.dumps(preprocessor)
+        picklable = True
+    except Exception:
+        picklable = False
+
+    try:
+        picklable_preprocessors[preprocessor] = picklable
+    except TypeError:
+        # Unhashable preprocessor
+        pass
+
+    return picklable
+
+def start_preprocessor_pool(max_workers=None, mp_context=None):
+    """
+    Run preprocessors in a long-lived pool of worker processes instead of the importing thread. Preprocessing,
+    especially with `recurse=True`, is pure CPU work. In combination with import_many(), many files are then
+    preprocessed concurrently on all cores. Preprocessors that cannot be pickled still run in the importing thread.
+
+    Like with any use of `multiprocessing`, the main module of your program must be importable without side effects,
+    i.e. guard it with `if __name__ == '__main__':`, if the start method is not `fork`.
+
+    Parameters:
+        max_workers (int): Number of worker processes. Defaults to the number of CPUs.
+
+        mp_context (multiprocessing.context.BaseContext): Multiprocessing context used to start the workers.
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: The worker pool
+    """
+    global preprocessor_pool
+    import atexit, concurrent.futures
+
+    with global_lock:
+        if not preprocessor_pool:
+            preprocessor_pool = concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=mp_context)
+            atexit.register(stop_preprocessor_pool)
+
+    return preprocessor_pool
+
+def stop_preprocessor_pool():
+    """ Shut down the worker processes started by start_preprocessor_pool(), preprocessors run inline again """
+    global preprocessor_pool
+
+    with global_lock:
+        pool, preprocessor_pool = preprocessor_pool, None
+
+    if pool:
+        pool.shutdown()
+
+def preprocess_in_worker(preprocessor, source, file_path):
+    """ Entry point in the worker process """
+    return preprocessor(source, file_path=file_path)
+
+def run_preprocessor(preprocessor, source, file_path):
+    """ Run a preprocessor, in the preprocessor pool if there is one """
+    pool = preprocessor_pool
+    if pool and is_picklable(preprocessor):
+        import concurrent.futures.process, pickle
+        try:
+            future = pool.submit(preprocess_in_worker, preprocessor, source, file_path)
+        except RuntimeError:
+            # The pool has been shut down or is broken, the preprocessor has not run yet
+            future = None
+        if future:
+            try:
+                return future.result()
+            except (concurrent.futures.process.BrokenProcessPool, pickle.PicklingError):
+                # A worker died or the data could not be sent between the processes, fall back to run inline.
+                # Errors of the preprocessor itself are raised as they are, the preprocessor must not run twice.
+                pass
+
+    return preprocessor(source, file_path=file_path)
+
+###########
 # REWRITE #
 ###########
 
-class RewriteImport(ast.NodeTransformer):
+class RewriteImport:
+    """
+    Rewrites relative import statements to ultraimport() calls.
 
-    def __init__(self, file_path=None, *args):
-        super().__init__(*args)
+    This is an `ast.NodeTransformer`, but `ast` is only imported when it is needed, so it does not inherit from it.
+    """
+
+    def __init__(self, file_path=None):
         self.file_path = file_path
 
+    def visit(self, node):
+        import ast
+        return ast.NodeTransformer.visit(self, node)
+
+    def generic_visit(self, node):
+        import ast
+        return ast.NodeTransformer.generic_visit(self, node)
+
     @classmethod
     def transform_imports(cls, source, file_path=None, use_cache=True):
+        import ast
 
         tree = ast.parse(source)
 
@@ -757,56 +2558,47 @@ class RewriteImport(ast.NodeTransformer):
         return unparsed.encode()
 
 
-    def gen_try(self, try_body, except_body = ast.Pass(), except_alias = 'e', except_error = 'ultraimport.ResolveImportError'):
-        if not except_body:
-            except_body = ast.Pass()
-        return ast.Try(
-            body=[try_body],
-            handlers=[
-                ast.ExceptHandler(
-                    type=ast.Name(id=except_error, ctx=ast.Load()),
-                    name=except_alias,
-                    body=[except_body],
-                ),
-            ],
-            orelse=[],
-            finalbody=[],
-        )
-
     def gen_assign(self, targets, value):
+        import ast
         return ast.Assign(
             targets=targets,
             value=value
         )
 
     def gen_keyword(self, name, value):
+        import ast
         if isinstance(value, ast.Tuple) or isinstance(value, ast.Call):
             return ast.keyword(arg=name, value=value)
         return ast.keyword(arg=name, value=ast.Constant(value=value, kind=None))
 
     def gen_call(self, name, args=[], keywords=[]):
+        import ast
         return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=keywords)
 
-    def gen_import_call(self, file_path, import_elts=None):
+    def gen_rewritten_import_call(self, candidates, code_info, star=False):
+        import ast
         keywords = [
-            self.gen_keyword('recurse', True),
-            # TODO: Remove and use cache
-            #self.gen_keyword('use_cache', False),
+            self.gen_keyword('code_info', code_info),
+            # Passing the caller saves walking the stack at runtime
+            ast.keyword(arg='caller', value=ast.Name(id='__file__', ctx=ast.Load())),
         ]
 
-        if import_elts == '*':
-            keywords.append(self.gen_keyword('add_to_ns', self.gen_call('add_to_ns')))
+        if star:
+            keywords.append(self.gen_keyword('add_to_ns', self.gen_call('globals')))
+
+        candidates_tuple = ast.Tuple(elts=[
+            ast.Tuple(elts=[ ast.Constant(value=path, kind=None), ast.Constant(value=objects, kind=None) ], ctx=ast.Load())
+            for path, objects in candidates
+        ], ctx=ast.Load())
 
         return ast.Call(
-            func=ast.Name(id='ultraimport', ctx=ast.Load()),
-            args=[
-                ast.Constant(value=file_path, kind=None),
-                self.gen_keyword('objects_to_import', import_elts)
-            ],
+            func=ast.Attribute(value=ast.Name(id='ultraimport', ctx=ast.Load()), attr='rewritten_import', ctx=ast.Load()),
+            args=[ candidates_tuple ],
             keywords=keywords
         )
 
     def gen_code_info(self, source, file_path, line, offset):
+        import ast
         return ast.Tuple(elts=[
                 ast.Constant(value=source, kind=None),
                 ast.Constant(value=file_path, kind=None),
@@ -816,51 +2608,9 @@ class RewriteImport(ast.NodeTransformer):
             ctx=ast.Load(),
         )
 
-    def gen_raise(self, alias, code_info, combine, object_to_import):
-        return ast.Raise(
-            exc=ast.Call(
-                func=ast.Name(id='ultraimport.RewrittenImportError', ctx=ast.Load()),
-                #args=[ast.Constant(value=message, kind=None)],
-                args=[],
-                keywords=[
-                    self.gen_keyword('code_info', code_info),
-                    self.gen_keyword('object_to_import', object_to_import),
-                    ast.keyword(
-                        arg='combine',
-                        value=ast.List(
-                            elts=[ ast.Name(id=name, ctx=ast.Load()) for name in combine ],
-                            ctx=ast.Load(),
-                        ),
-                    ),
-                ],
-            ),
-            #cause=None,
-            cause=ast.Constant(value=None, kind=None),
-        )
-
-    def gen_import(self, alias, module_path, object_name=None):
-        if object_name == '*':
-            return self.gen_import_call(module_path, object_name)
-        elif object_name:
-            objects_tuple = self.gen_objects_tuple([object_name])
-            aliasses_tuple = self.gen_aliasses_tuple([alias])
-            call_node = self.gen_import_call(module_path, objects_tuple)
-            return self.gen_assign([aliasses_tuple], call_node)
-
-        call_node = self.gen_import_call(module_path)
-        assign_node = self.gen_assign([ast.Name(id=alias, ctx=ast.Store())], call_node)
-        return assign_node
-
-    def gen_aliasses_tuple(self, aliasses):
-        return ast.Tuple(elts=[ ast.Name(id=alias, ctx=ast.Store()) for alias in aliasses ], ctx=ast.Store())
-
-    def gen_objects_tuple(self, object_names):
-        if not object_names:
-            return None
-        return ast.Tuple(elts=[ast.Constant(value=name) for name in object_names], ctx=ast.Load())
-
     def visit_ImportFrom(self, node):
         """ Rewrite all `import .. from` statements """
+        import ast
 
         node = self.generic_visit(node)
 
@@ -876,33 +2626,38 @@ class RewriteImport(ast.NodeTransformer):
 
         for n in node.names:
             name = n.name if not node.module else node.module
+            module_name = name.replace('.', os.sep)
             module_path = f"__dir__/{up}__init__.py"
-            module2_path = f"__dir__/{up}{name}/__init__.py"
-            module3_path = f"__dir__/{up}{name}.py"
+            module2_path = f"__dir__/{up}{module_name}/__init__.py"
+            module3_path = f"__dir__/{up}{module_name}.py"
             alias = n.asname if n.asname else n.name
 
-            try_node = None
+            # Candidates of files and objects to import, in the order they are tried
+            if node.module:
+                object_name = n.name
+                candidates = [ (module2_path, n.name), (module3_path, n.name) ]
+            else:
+                object_name = name
+                candidates = [ (module_path, name), (module2_path, name), (module3_path, None) ]
 
-            code_info = self.gen_code_info(source=ast.unparse(node), file_path=self.file_path, line=node.lineno, offset=node.col_offset)
+            # We know where the rewritten file is, so the paths are resolved already. All candidates are kept and
+            # probed at runtime: the rewritten code is cached independently of which files exist, so files created
+            # later must still be found.
+            if self.file_path:
+                dir_name = os.path.dirname(os.path.abspath(self.file_path))
+                candidates = [ (os.path.normpath(path.replace('__dir__', dir_name)), objects) for path, objects in candidates ]
 
-            if node.module:
-                import1_node = self.gen_import(alias, module2_path, n.name)
-                import2_node = self.gen_import(alias, module3_path, n.name)
-                raise_node = self.gen_raise(name, combine=['e', 'e2'], code_info=code_info, object_to_import=n.name)
-                try2_node = self.gen_try(import2_node, raise_node, 'e2')
-                try_node = self.gen_try(import1_node, try2_node, 'e')
+            code_info = self.gen_code_info(source=ast.unparse(node), file_path=self.file_path, line=node.lineno, offset=node.col_offset)
 
+            # A single call tries all candidates, the first one providing the object wins
+            call_node = self.gen_rewritten_import_call(candidates, code_info, star=object_name == '*')
+            if object_name == '*':
+                import_node = ast.Expr(value=call_node)
             else:
-                import1_node = self.gen_import(alias, module_path, name)
-                import2_node = self.gen_import(alias, module2_path, name)
-                import3_node = self.gen_import(alias, module3_path)
-                raise_node = self.gen_raise(name, combine=['e', 'e2', 'e3'], code_info=code_info, object_to_import=name)
-                try3_node = self.gen_try(import3_node, raise_node, 'e3')
-                try2_node = self.gen_try(import2_node, try3_node, 'e2')
-                try_node = self.gen_try(import1_node, try2_node, 'e')
+                import_node = self.gen_assign([ast.Name(id=alias, ctx=ast.Store())], call_node)
 
-            imports.append(try_node)
-            ast.copy_location(try_node, node)
+            imports.append(import_node)
+            ast.copy_location(import_node, node)
 
         return imports
 
@@ -910,6 +2665,89 @@ class RewriteImport(ast.NodeTransformer):
 # HELPER #
 ##########
 
+def resolve_file_path(file_path, caller):
+    """ Replace the special string `__dir__` with the directory of the caller and return the absolute file path """
+    if '__dir__' in file_path:
+        file_path = file_path.replace('__dir__', os.path.dirname(caller))
+
+    return os.path.abspath(file_path)
+
+def combine_preprocessor(preprocessor, recurse):
+    """
+    If we want to recurse, we need to add our recurse preprocessor to any other preprocessor from the user.
+    """
+    if not recurse:
+        return preprocessor
+
+    return RecursePreprocessor(preprocessor)
+
+def prefetch_loader(file_path, *args, **kwargs):
+    """ Create a loader and let it read, preprocess and compile the file. Returns `None` for unloadable files. """
+    try:
+        check_file_is_importable(file_path, file_path)
+    except ResolveImportError:
+        return None
+
+    loader = Loader(get_module_name(file_path), file_path, *args, **kwargs)
+    if isinstance(loader, SourceFileLoader):
+        loader.prefetch()
+    return loader
+
+def get_prefetched_loader(key):
+    """ Return a loader prepared by import_many() or Manifest.prefetch() or `None` """
+    try:
+        future = prefetched.pop(key, None)
+    except TypeError:
+        # Unhashable preprocessor
+        return None
+
+    if not future:
+        return None
+
+    try:
+        return future.result()
+    except Exception:
+        # Let the regular import raise the error again, so it is reported at the right place
+        return None
+
+def get_object_reference(obj):
+    """ Return `'module:qualified.name'` for an object that can be found again by that name, otherwise `None` """
+    module_name, qualname = getattr(obj, '__module__', None), getattr(obj, '__qualname__', None)
+    if not module_name or not qualname or module_name == '__main__':
+        return None
+    # Only look at imported modules, recording an import must not import anything
+    found = sys.modules.get(module_name)
+    for name in qualname.split('.'):
+        found = getattr(found, name, None)
+    return f'{module_name}:{qualname}' if found is obj else None
+
+def resolve_object_reference(reference):
+    """ Return the object for a reference created by get_object_reference() or `None` """
+    module_name, _, qualname = reference.partition(':')
+    try:
+        obj = importlib.import_module(module_name)
+        for name in qualname.split('.'):
+            obj = getattr(obj, name)
+    except (ImportError, AttributeError):
+        return None
+    return obj
+
+def write_file_atomic(file_path, data):
+    """ Write a file so that other processes never see a partially written file """
+    dir_name = os.path.dirname(file_path)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+
+    tmp_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_file_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file_path)
+        raise
+
 def search_module_path(module):
     spec = importlib.util.find_spec(module)
     if spec and hasattr(spec, 'origin'):
@@ -917,6 +2755,9 @@ def search_module_path(module):
 
     raise Exception(f'Module "{module}" not found')
 
+# Suffixes of importable files, longest first, like in inspect.getmodulename()
+module_suffixes = sorted(importlib.machinery.all_suffixes(), key=len, reverse=True)
+
 def get_module_name(file_path):
     """
     Return Python compatible module name from file_path. Replace dash and dot characters with underscore characters.
@@ -928,12 +2769,15 @@ def get_module_name(file_path):
         module_name (str): Extracted and escaped name of the module
     """
 
-    # Try Python internal approach first
-    name = inspect.getmodulename(file_path)
-
-    # If Python cannot determine a name, we will simply split off any file extensions
-    if not name:
-        name, suffix = os.path.splitext(os.path.basename(file_path))
+    # Try Python internal approach first, like inspect.getmodulename()
+    file_name = os.path.basename(file_path)
+    for suffix in module_suffixes:
+        if file_name.endswith(suffix):
+            name = file_name[:-len(suffix)]
+            break
+    else:
+        # If Python cannot determine a name, we will simply split off any file extensions
+        name, suffix = os.path.splitext(file_name)
 
     # And replace all illegal characters
     return name.replace('-', '_').replace('.', '_')
@@ -957,21 +2801,27 @@ def get_package_name(file_path, package):
         package_path (str): Path to the package
         package_module (types.ModuleType): Package module object
     """
-    path = os.path.abspath(file_path if os.path.isdir(file_path) else os.path.dirname(file_path))
-    if type(package) == str:
-        rest, dot, name = package.rpartition('.')
-        parent_package = None
-        if rest:
-            parent_package = get_package_name(os.path.dirname(file_path), rest)
-        package_module = create_ns_package(package, path)
-        if parent_package:
-            package_module.__package__ = parent_package
-        return package, path, package_module
-    elif type(package) == int:
-        pathes = os.path.dirname(os.path.abspath(file_path)).split(os.sep)[-package:]
+    if package is None:
+        return None, None, None
+
+    key = (file_path, package)
+    resolved = resolved_packages.get(key)
+    # The package might have been replaced or removed from `sys.modules` in the meantime
+    if resolved and sys.modules.get(resolved[0]) is resolved[2]:
+        return resolved
+
+    path = os.path.abspath(file_path if is_dir(file_path) else os.path.dirname(file_path))
+    if type(package) == int:
+        pathes = path.split(os.sep)[-package:]
         package = '.'.join(pathes)
-        return get_package_name(path, package)
-    return None, None, None
+    elif type(package) != str:
+        return None, None, None
+
+    # Parent packages are created by `create_ns_package()`
+    with global_lock:
+        package_module = create_ns_package(package, path)
+    resolved = resolved_packages[key] = (package, path, package_module)
+    return resolved
 
 def find_caller(return_frame=False):
     """
@@ -987,7 +2837,7 @@ def find_caller(return_frame=False):
         str, frame: A string with the caller name, the stack frame that was used to extract the caller name
     """
 
-    frame = inspect.currentframe()
+    frame = sys._getframe()
 
     # Note: If we run a compiled ultraimport module from Python REPL, there will only be one frame
     #       on the stack called <stdin>, and there will be no ultraimport frame, so __do not__ go back
@@ -1019,6 +2869,23 @@ def find_caller(return_frame=False):
 
     return caller
 
+def get_caller_code():
+    """
+    Return the code object of the first frame outside of ultraimport. Unlike find_caller(), this does not look
+    any further, so it is cheap enough for the fast path of ultraimport().
+
+    Returns:
+        code: Code object of the caller or `None` if the caller has no real file, e.g. in a Python REPL.
+    """
+    frame = sys._getframe()
+    while frame and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+
+    if not frame or frame.f_code.co_filename.startswith('<'):
+        return None
+
+    return frame.f_code
+
 def create_ns_package(package_name, package_path, caller=None):
     """
     Create one or more dynamic namespace packages on the fly.
@@ -1042,38 +2909,166 @@ def create_ns_package(package_name, package_path, caller=None):
 
     rest, dot, name = package_name.rpartition('.')
     # Make sure to create parent package first
+    parent = None
     if rest:
-        create_ns_package(rest, os.path.dirname(package_path), caller=caller)
+        parent = create_ns_package(rest, os.path.dirname(package_path), caller=caller)
+
+    # Reuse an existing package so modules that are already attached to it stay reachable
+    package = sys.modules.get(package_name)
+    if package is not None and hasattr(package, '__path__'):
+        if package_path not in package.__path__:
+            package.__path__.append(package_path)
+    else:
+        # A path finder that never finds anything keeps `__path__` as we set it, even if the path of the parent
+        # package changes or `importlib.invalidate_caches()` is called
+        loader = importlib._bootstrap_external._NamespaceLoader('loader', [package_path], find_no_spec)
+        spec = importlib.util.spec_from_loader(package_name, loader)
+        package = importlib.util.module_from_spec(spec)
+        package.__path__ = loader._path
+        sys.modules[package_name] = package
+
+    if parent is not None and getattr(parent, name, None) is not package:
+        setattr(parent, name, package)
 
-    loader = importlib._bootstrap_external._NamespaceLoader('loader', [package_path], None)
-    spec = importlib.util.spec_from_loader(package_name, loader)
-    package = importlib.util.module_from_spec(spec)
-    package.__path__ = loader._path
-    sys.modules[package_name] = package
     return package
 
+def find_no_spec(name, path):
+    return None
+
 def find_existing_module_by_path(file_path):
-    for name, module in sys.modules.items():
-        if module.__file__ == os.path.abspath(file_path):
-            return module
+    """ Return the module ultraimport has loaded last from `file_path` or `None` """
+    return modules_by_path.get(os.path.abspath(file_path))
 
-    return None
+def get_unique_module_name(file_path, name=None):
+    """
+    Return the name for the module of `file_path` in `sys.modules`. It is the name returned by get_module_name()
+    followed by a short hash of the resolved file path, e.g. `utils_1a2b3c4d` for `/a/utils.py`. The name only
+    depends on the path, so modules from files with the same name never replace each other or other modules like
+    `json` in `sys.modules`. Every process uses the same name for a file, no matter in which order files are
+    imported, which is needed e.g. for pickling.
+
+    Parameters:
+        file_path (str): Resolved file path of the module
+        name (str): Result of get_module_name() for `file_path`, if it is already known
+
+    Returns:
+        str: The unique module name
+    """
+    import hashlib
+    return f"{name or get_module_name(file_path)}_{hashlib.sha256(os.fsencode(file_path)).hexdigest()[:8]}"
+
+def enable_stat_cache(check_mtime=True):
+    """
+    Serve the file system checks of ultraimport from directory listings in memory. This saves many system calls,
+    which is especially useful on network file systems.
+
+    Parameters:
+        check_mtime (bool): If `True`, a cached directory listing is renewed when the modification time of the
+            directory changes, which costs a single `stat()` call per check. If `False`, listings are only renewed
+            after calling `invalidate()` on the returned StatCache.
+
+    Returns:
+        StatCache: The stat cache, use its `stats()` method to see how many system calls were saved
+    """
+    global stat_cache
+    stat_cache = StatCache(check_mtime=check_mtime)
+    return stat_cache
+
+def disable_stat_cache():
+    """ Query the file system directly again """
+    global stat_cache
+    stat_cache = None
+
+def path_exists(file_path):
+    """ Check if `file_path` exists """
+    if stat_cache:
+        return stat_cache.exists(file_path)
+    import_stats.counters['stat_calls'] += 1
+    return os.path.exists(file_path)
+
+def is_file(file_path):
+    """ Check if a regular file exists at `file_path` """
+    if stat_cache:
+        return stat_cache.isfile(file_path)
+    import_stats.counters['stat_calls'] += 1
+    return os.path.isfile(file_path)
+
+def is_dir(file_path):
+    """ Check if a directory exists at `file_path` """
+    if stat_cache:
+        return stat_cache.isdir(file_path)
+    import_stats.counters['stat_calls'] += 1
+    return os.path.isdir(file_path)
+
+def file_status(file_path):
+    """
+    Returns:
+        tuple: Whether `file_path` exists, is a regular file and is readable
+    """
+    if stat_cache:
+        return stat_cache.status(file_path)
+    import_stats.counters['stat_calls'] += 3
+    return os.path.exists(file_path), os.path.isfile(file_path), os.access(file_path, os.R_OK)
+
+def get_mtime(file_path):
+    """ Return the modification time of `file_path` in nanoseconds or `None` if it does not exist """
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except OSError:
+        return None
 
 def check_file_is_importable(file_path, file_path_orig, caller_reference=None):
-    if not os.path.exists(file_path):
+    exists, isfile, readable = file_status(file_path)
+    if not exists:
         raise ResolveImportError('File does not exist.', file_path=file_path_orig,
                                  file_path_resolved=file_path, caller_reference=caller_reference)
 
-    if not os.path.isfile(file_path):
+    if not isfile:
         raise ResolveImportError('Object exists but is not a file.', file_path=file_path_orig,
                                  file_path_resolved=file_path, caller_reference=caller_reference)
 
-    if not os.access(file_path, os.R_OK):
+    if not readable:
         raise ResolveImportError('File exists but no read access.', file_path=file_path_orig,
                                  file_path_resolved=file_path, caller_reference=caller_reference)
 
     return True
 
+def get_import_ongoing_stack():
+    """ Return the dict of imports that are currently ongoing in the calling thread """
+    try:
+        return import_ongoing.stack
+    except AttributeError:
+        import_ongoing.stack = {}
+        return import_ongoing.stack
+
+@contextlib.contextmanager
+def import_lock(file_path, file_path_orig=None):
+    """
+    Hold the ImportLock of a resolved file path for the duration of the context.
+
+    Raises a CircularImportError if waiting for the lock would deadlock, i.e. if the imports of several
+    threads depend on each other in a circle.
+    """
+    with global_lock:
+        lock = import_locks.get(file_path)
+        if not lock:
+            lock = import_locks[file_path] = ImportLock()
+        lock.users += 1
+
+    try:
+        if not lock.acquire():
+            raise CircularImportError(file_path=file_path_orig or file_path, file_path_resolved=file_path)
+        try:
+            yield lock
+        finally:
+            lock.release()
+    finally:
+        with global_lock:
+            lock.users -= 1
+            # Drop locks nobody uses anymore, so we don't keep one lock per file ever imported
+            if not lock.users:
+                del import_locks[file_path]
+
 def reload(ns=None, add_to_ns=True):
     """ Reload ultraimport module """
     count = reload_counter
@@ -1083,6 +3078,533 @@ def reload(ns=None, add_to_ns=True):
 
     return reloaded
 
+################
+# INVALIDATION #
+################
+
+def add_dependency(file_path, importer):
+    """ Record that the file `importer` imports the file `file_path`, both are resolved file paths """
+    if file_path != importer:
+        dependents.setdefault(file_path, set()).add(importer)
+
+def get_dependents(file_path, cascade=True):
+    """
+    Return the files that import the resolved `file_path`, as far as ultraimport has seen them.
+
+    Parameters:
+        cascade (bool): Also return the files importing those files and so on, not only the direct dependents
+
+    Returns:
+        list: Resolved file paths, closest dependents first
+    """
+    found = []
+    seen = { file_path }
+    queue = collections.deque([ file_path ])
+    while queue:
+        for importer in sorted(dependents.get(queue.popleft(), ())):
+            if importer not in seen:
+                seen.add(importer)
+                found.append(importer)
+                if cascade:
+                    queue.append(importer)
+    return found
+
+def invalidate(file_path, cascade=True, caller=None):
+    """
+    Evict a file and the files that import it from `cache`, `sys.modules` and the preprocessor cache. The next
+    ultraimport() call for any of them imports the file again, while all other modules stay cached.
+
+    Parameters:
+        file_path (str): Path of the file, relative paths and `__dir__` are resolved like in ultraimport()
+
+        cascade (bool): Also evict all files that import the file directly or indirectly. If set to `False`, only
+            the file itself is evicted and modules that have already imported it keep using the old module.
+
+        caller (str): Can be set `caller=__file__` to save some CPU cycles. Otherwise it will be derived from the current
+            stack.
+
+    Returns:
+        list: Resolved file paths of all evicted files
+    """
+    if not os.path.isabs(file_path):
+        file_path = resolve_file_path(file_path, caller or find_caller())
+
+    file_paths = [ file_path ] + (get_dependents(file_path) if cascade else [])
+    evicted = set(file_paths)
+
+    with global_lock:
+        for key, module in list(cache.items()):
+            if key[0] in evicted:
+                del cache[key]
+                loader = types.ModuleType.__getattribute__(module, '__dict__').get('__loader__')
+                drop_module(module, key[0])
+                remove_preprocessed_file(loader)
+
+    return file_paths
+
+def unload(file_path, caller=None):
+    """
+    Remove the modules of a file from `cache`, `sys.modules` and their parent package, so they can be garbage
+    collected as soon as nobody else references them. The next ultraimport() call imports the file again.
+
+    Parameters:
+        file_path (str): Path of the file, relative paths and `__dir__` are resolved like in ultraimport()
+
+        caller (str): Can be set `caller=__file__` to save some CPU cycles. Otherwise it will be derived from the current
+            stack.
+
+    Returns:
+        int: Number of unloaded modules
+    """
+    if not os.path.isabs(file_path):
+        file_path = resolve_file_path(file_path, caller or find_caller())
+
+    count = 0
+    with global_lock:
+        for key, module in list(cache.items()):
+            if key[0] == file_path:
+                del cache[key]
+                drop_module(module, file_path)
+                count += 1
+
+        # Modules imported with `use_cache=False` are not in `cache`
+        module = find_existing_module_by_path(file_path)
+        if module is not None:
+            drop_module(module, file_path)
+            count += 1
+
+    import_stats.counters['unloads'] += count
+    return count
+
+def drop_module(module, file_path):
+    """ Remove all references ultraimport has created to a module that has been removed from `cache` """
+    # Read the module attributes without executing lazy modules
+    attributes = types.ModuleType.__getattribute__(module, '__dict__')
+    name = attributes.get('__name__')
+    for module_name in { name, get_unique_module_name(file_path) }:
+        if sys.modules.get(module_name) is module:
+            del sys.modules[module_name]
+    if modules_by_path.get(file_path) is module:
+        del modules_by_path[file_path]
+
+    package = sys.modules.get(attributes.get('__package__') or '')
+    if package is not None and name:
+        short_name = name.rpartition('.')[2]
+        if getattr(package, short_name, None) is module:
+            delattr(package, short_name)
+
+    # Drop the source code and code objects the loader still holds
+    loader = attributes.get('__loader__')
+    if isinstance(loader, SourceFileLoader):
+        loader.code = None
+        loader.code_object = None
+
+    for key in [ key for key in prefetched if key[0] == file_path ]:
+        future = prefetched.pop(key, None)
+        if future:
+            future.cancel()
+
+    # Drop everything else that is kept per file path, otherwise memory grows with every file ever imported.
+    # Other threads may add entries at any time, so iterate over copies.
+    import_stats.files.pop(file_path, None)
+    for key in [ key for key in list(resolved_packages) if key[0] == file_path ]:
+        resolved_packages.pop(key, None)
+    for key, cache_key in list(resolved_cache_keys.items()):
+        if cache_key[0] == file_path:
+            resolved_cache_keys.pop(key, None)
+    # The file records its dependencies again when it is executed again. Its own dependents are kept as long as
+    # they are loaded, so invalidate() still finds them.
+    for path, importers in list(dependents.items()):
+        importers.discard(file_path)
+        if not importers:
+            dependents.pop(path, None)
+
+class BoundedCache(collections.OrderedDict):
+    """
+    Module cache that holds at most `max_modules` modules. When it is full, the least recently used module is
+    unloaded, see unload(). Use limit_cache() to install it.
+    """
+
+    def __init__(self, max_modules, on_evict=None, entries=()):
+        self.max_modules = max_modules
+        self.on_evict = on_evict
+        self.evictions = 0
+        super().__init__(entries)
+
+    def get(self, key, default=None):
+        # Other threads may evict the module at any time, so look it up first and mark it as used afterwards
+        try:
+            module = self[key]
+        except KeyError:
+            return default
+        with contextlib.suppress(KeyError):
+            self.move_to_end(key)
+        return module
+
+    def __setitem__(self, key, module):
+        super().__setitem__(key, module)
+        self.evict()
+
+    def evict(self):
+        while len(self) > self.max_modules:
+            with global_lock:
+                try:
+                    key, module = self.popitem(last=False)
+                except KeyError:
+                    return
+                drop_module(module, key[0])
+            self.evictions += 1
+            import_stats.counters['cache_evictions'] += 1
+            if self.on_evict:
+                self.on_evict(key[0], module)
+
+def limit_cache(max_modules=None, on_evict=None):
+    """
+    Limit the number of modules in `cache`. Modules that have not been used for the longest time are unloaded when
+    the limit is reached, they are imported again when they are needed again. Evictions are counted in stats().
+
+    Parameters:
+        max_modules (int): Maximum number of cached modules, `None` removes the limit
+
+        on_evict (callable): Called with the resolved file path and the module of every evicted module
+
+    Returns:
+        dict: The new `ultraimport.cache`
+    """
+    global cache
+
+    with global_lock:
+        if max_modules is None:
+            cache = dict(cache)
+        else:
+            cache = BoundedCache(max_modules, on_evict, cache)
+
+    return cache
+
+def remove_preprocessed_file(loader):
+    """
+    Remove the preprocessed code cached by a loader, so the file is preprocessed again on the next import. Depending
+    on the options of the loader, this is the preprocessed file, the code cache file or the entries in `cache_backend`.
+    """
+    if not isinstance(loader, SourceFileLoader) or not loader.preprocessor:
+        return
+
+    if loader.cache_backend:
+        loader.cache_backend.delete(f"source:{loader.path}")
+        loader.cache_backend.delete(f"code:{loader.path}")
+        return
+
+    for file_path in (loader.preprocess_file_path, loader.code_cache_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+###########
+# WATCHER #
+###########
+
+def reload_module(module):
+    """
+    Execute the code of a module loaded by ultraimport again, in the same module object. Like `importlib.reload()`,
+    everybody holding a reference to the module sees the new code, other modules are not reloaded.
+    """
+    spec = module.__spec__
+    loader = spec.loader
+    if not isinstance(loader, SourceFileLoader):
+        raise ImportError(f"Cannot reload '{module.__name__}', it is not a Python source file")
+
+    file_path = loader.path
+    with import_lock(file_path), import_stats.measure(file_path, time.perf_counter()):
+        # A new loader preprocesses the file again, if necessary
+        loader = Loader(loader.name, file_path, preprocessor=loader.preprocessor, use_cache=loader.use_cache,
+                        cache_path_prefix=loader.cache_path_prefix, use_code_cache=loader.use_code_cache,
+                        cache_backend=loader.cache_backend)
+        spec.loader = module.__loader__ = loader
+        loader.exec_module(module)
+
+    return module
+
+class Inotify:
+    """ Minimal binding of the Linux inotify API with `ctypes`, raises `OSError` if it is not available """
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        # Watch descriptor -> directory
+        self.directories = {}
+
+    def add_watch(self, dir_name):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_name), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch() failed for '{dir_name}'")
+        self.directories[wd] = dir_name
+
+    def read(self, timeout):
+        """ Wait up to `timeout` seconds for events and return the paths of the files that changed """
+        import select, struct
+
+        if not select.select([ self.fd ], [], [], timeout)[0]:
+            return set()
+
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self.directories and name:
+                changed.add(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    """
+    Watch the files of all modules in `ultraimport.cache` and reload single modules when their file changes,
+    see watch(). Changes are noticed with inotify where available, otherwise by polling the modification times.
+    """
+
+    def __init__(self, interval=0.5, callback=None, use_inotify=True):
+        self.interval = interval
+        self.callback = callback or self.print_results
+        # File path -> modification time, for all watched files
+        self.mtimes = {}
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                pass
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sync(self):
+        """ Start watching files imported since the last call, stop watching files that left the cache """
+        file_paths = { file_path for file_path, package in list(cache) }
+        for file_path in self.mtimes.keys() - file_paths:
+            del self.mtimes[file_path]
+        for file_path in file_paths - self.mtimes.keys():
+            self.mtimes[file_path] = get_mtime(file_path)
+            if self.inotify:
+                dir_name = os.path.dirname(file_path)
+                if dir_name not in self.inotify.directories.values():
+                    try:
+                        self.inotify.add_watch(dir_name)
+                    except OSError:
+                        pass
+
+    def check(self, file_paths=None):
+        """ Return the watched files that have a new modification time, all watched files are checked by default """
+        changed = []
+        for file_path in self.mtimes.keys() if file_paths is None else file_paths & self.mtimes.keys():
+            mtime = get_mtime(file_path)
+            if mtime != self.mtimes[file_path]:
+                self.mtimes[file_path] = mtime
+                if mtime is not None:
+                    changed.append(file_path)
+        return changed
+
+    def reload(self, file_paths):
+        """
+        Reload the modules of the given files.
+
+        Returns:
+            list: Tuples of file path, seconds it took and the exception or `None`
+        """
+        results = []
+        for (file_path, package), module in list(cache.items()):
+            if file_path not in file_paths:
+                continue
+            started = time.perf_counter()
+            error = None
+            # Lazy modules that have not been used yet will execute the new code anyway
+            if type(module) is not LazyModule:
+                try:
+                    reload_module(module)
+                except Exception as e:
+                    error = e
+            results.append((file_path, time.perf_counter() - started, error))
+        return results
+
+    def poll(self, timeout=0):
+        """ Check for changes once and reload the changed modules, waiting up to `timeout` seconds for inotify events """
+        self.sync()
+        if self.inotify:
+            changed = self.check(self.inotify.read(timeout))
+        else:
+            changed = self.check()
+        results = self.reload(changed) if changed else []
+        if results:
+            self.callback(results)
+        return results
+
+    def print_results(self, results):
+        for file_path, duration, error in results:
+            if error:
+                print(f'ultraimport: Reloading {file_path} failed after {duration * 1000:.1f} ms: {error!r}', file=sys.stderr)
+            else:
+                print(f'ultraimport: Reloaded {file_path} in {duration * 1000:.1f} ms', file=sys.stderr)
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.inotify:
+                self.poll(self.interval)
+            else:
+                self.poll()
+                self.stopped.wait(self.interval)
+
+    def start(self):
+        self.sync()
+        self.thread = threading.Thread(target=self.run, name='ultraimport-watcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+def watch(interval=0.5, callback=None, use_inotify=True):
+    """
+    Watch the files of all imported modules in a background thread and reload a module as soon as its file changes.
+    Only the changed modules are executed again, in place, so existing references to them see the new code.
+
+    Parameters:
+        interval (float): Seconds between checks for new imports and, without inotify, for changed files
+
+        callback (callable): Called with a list of tuples of file path, seconds the reload took and the exception
+            or `None` for every round of reloads. By default, a line per reload is printed to stderr.
+
+        use_inotify (bool): Use inotify on Linux instead of polling the modification times of all files
+
+    Returns:
+        Watcher: The running watcher, call `stop()` to end watching
+    """
+    return Watcher(interval=interval, callback=callback, use_inotify=use_inotify).start()
+
+################
+# COMMAND LINE #
+################
+
+def compile_file(file_path, preprocessor=None, recurse=False, cache_path_prefix=None, use_code_cache=False):
+    """
+    Preprocess a file and write the preprocessed file and its bytecode, exactly like the first import would do.
+
+    Parameters:
+        preprocessor (str): Reference to the preprocessor function as `'module:function'`
+
+    Returns:
+        str: Error message or `None` on success
+    """
+    # Writing the caches is the whole point of this command
+    sys.dont_write_bytecode = False
+    try:
+        if preprocessor:
+            reference, preprocessor = preprocessor, resolve_object_reference(preprocessor)
+            if not preprocessor:
+                return f"Preprocessor '{reference}' not found"
+        loader = Loader(get_module_name(file_path), file_path, preprocessor=combine_preprocessor(preprocessor, recurse),
+                        cache_path_prefix=cache_path_prefix, use_code_cache=use_code_cache)
+        if isinstance(loader, SourceFileLoader):
+            loader.get_code(loader.name)
+    except Exception as e:
+        return f'{e.__class__.__name__}: {e}'
+    return None
+
+def find_source_files(paths, cache_path_prefix=None):
+    """ Yield all Python source files in `paths`, directories are walked recursively """
+    skip_dirs = { '__pycache__', cache_path_prefix }
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path)
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names[:] = sorted(name for name in dir_names if name not in skip_dirs and not name.startswith('.'))
+            for file_name in sorted(file_names):
+                name, suffix = os.path.splitext(file_name)
+                if suffix in importlib.machinery.SOURCE_SUFFIXES and not name.endswith('__preprocessed__'):
+                    yield os.path.abspath(os.path.join(dir_path, file_name))
+
+def main(argv=None):
+    """
+    Command line interface, run `python -m ultraimport --help` for usage.
+
+    Returns:
+        int: Exit code, not zero if any file failed
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m ultraimport', description='ultraimport command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = commands.add_parser('compile', help='write preprocessed files and bytecode ahead of time',
+        description='Preprocess and compile all Python files in the given directories, so the first import does not '
+                    'need to. Use the same preprocessor options as for the imports.')
+    compile_parser.add_argument('paths', nargs='+', help='directories or files to compile')
+    compile_parser.add_argument('--recurse', action='store_true', help='rewrite relative imports like recurse=True')
+    compile_parser.add_argument('--preprocessor', metavar='MODULE:FUNCTION', help='preprocessor function to use')
+    compile_parser.add_argument('--cache-path-prefix', metavar='DIR', help='directory for preprocessed files')
+    compile_parser.add_argument('--use-code-cache', action='store_true', help='cache code objects like use_code_cache=True')
+    compile_parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes, defaults to the number of CPUs')
+    compile_parser.add_argument('-q', '--quiet', action='store_true', help='only print errors')
+
+    args = parser.parse_args(argv)
+
+    if args.preprocessor and not resolve_object_reference(args.preprocessor):
+        parser.error(f"preprocessor '{args.preprocessor}' not found, use the format MODULE:FUNCTION")
+
+    files = list(find_source_files(args.paths, args.cache_path_prefix))
+    options = dict(preprocessor=args.preprocessor, recurse=args.recurse, cache_path_prefix=args.cache_path_prefix,
+                   use_code_cache=args.use_code_cache)
+
+    if args.jobs == 1 or len(files) < 2:
+        errors = [ compile_file(file_path, **options) for file_path in files ]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            futures = [ executor.submit(compile_file, file_path, **options) for file_path in files ]
+            errors = []
+            for future in futures:
+                try:
+                    errors.append(future.result())
+                except Exception as e:
+                    # E.g. a worker process died
+                    errors.append(f'{e.__class__.__name__}: {e}')
+
+    failed = 0
+    for file_path, error in zip(files, errors):
+        if error:
+            failed += 1
+            print(f'{file_path}: {error}', file=sys.stderr)
+
+    if not args.quiet:
+        print(f'Compiled {len(files) - failed} files, {failed} failed')
+
+    return 1 if failed else 0
+
 class CallableModule(types.ModuleType):
     """ Makes ultraimport directly callable after doing `import ultraimport` """
     def __call__(self, *args, **kwargs):
@@ -1090,3 +3612,15 @@ class CallableModule(types.ModuleType):
 
 sys.modules[__name__].__class__ = CallableModule
 __path__ = os.path.dirname(__file__)
+
+if os.environ.get('ULTRAIMPORT_MANIFEST'):
+    import atexit
+    # Replay the previous run and record this one for the next
+    manifest.prefetch(os.environ['ULTRAIMPORT_MANIFEST'])
+    manifest.start()
+    atexit.register(manifest.save, os.environ['ULTRAIMPORT_MANIFEST'])
+
+if __name__ == '__main__':
+    # Run with the regular module instead of `__main__`, so worker processes and rewritten imports use the same one
+    import ultraimport
+    sys.exit(ultraimport.main())